@@ -0,0 +1,198 @@
+#! /usr/bin/env python
+
+"""
+Benchmarks for the generated zoneinfo module: import time, per call latency of
+the tzinfo methods across all zones, and optionally the build itself. Results
+are written as JSON and can be checked against an earlier run.
+
+Copyright (c) 2012 Garrick Peterson
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Wall times every week through a year, at varying hours, so the per zone
+# period cache sees mostly new keys
+ERAS = {
+    "historical": 1950,
+    "current": datetime.now().year,
+    "future": 2050,
+}
+SAMPLES = 52
+
+def sample_datetimes(year):
+    return [datetime(year, 1 + i * 12 // SAMPLES, 1 + i % 28, i * 5 % 24, i * 7 % 60)
+            for i in range(SAMPLES)]
+
+def load_generated():
+    # The generated module shadows the stdlib zoneinfo, so it is loaded from
+    # the current directory explicitly
+    sys.path.insert(0, os.getcwd())
+    import zoneinfo
+    return zoneinfo
+
+def load_stdlib_zoneinfo():
+    # The stdlib zoneinfo reading system TZif files, under another name
+    path = os.path.join(sysconfig.get_paths()['stdlib'], 'zoneinfo', '__init__.py')
+    if not os.path.exists(path):
+        return None
+    spec = importlib.util.spec_from_file_location(
+        '_stdlib_zoneinfo', path, submodule_search_locations=[os.path.dirname(path)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def time_import(repeat):
+    # Each import is timed in a fresh interpreter
+    code = ("import sys, time; sys.path.insert(0, %r); t = time.perf_counter(); "
+            "import zoneinfo; print(time.perf_counter() - t)" % (os.getcwd(),))
+    return min(float(subprocess.check_output([sys.executable, '-c', code]))
+               for _ in range(repeat))
+
+def time_calls(zones, repeat):
+    # Nanoseconds per call, over every zone and sample time
+    results = {}
+    for era, year in sorted(ERAS.items()):
+        naive = sample_datetimes(year)
+        local = [[dt.replace(tzinfo=tz) for dt in naive] for tz in zones]
+        utc = [dt.replace(tzinfo=timezone.utc) for dt in naive]
+        calls = len(zones) * len(naive)
+        timings = {}
+        for name, run in (("utcoffset", lambda: [dt.utcoffset() for dts in local for dt in dts]),
+                          ("dst", lambda: [dt.dst() for dts in local for dt in dts]),
+                          ("tzname", lambda: [dt.tzname() for dts in local for dt in dts]),
+                          ("astimezone", lambda: [dt.astimezone(tz) for tz in zones for dt in utc])):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best / calls * 1e9
+        results[era] = timings
+    return results
+
+def time_build(data_path, repeat):
+    # Builds into a scratch directory, so the module being measured stays
+    import make_zoneinfo
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp()
+    best = None
+    try:
+        os.chdir(scratch)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            make_zoneinfo.main(data_path)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+    return best
+
+def flatten(results, prefix=''):
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + '.'):
+                yield item
+        elif isinstance(value, float):
+            yield prefix + key, value
+
+def regressions(results, baseline, threshold):
+    # Metrics that got slower than the baseline by more than the threshold;
+    # the stdlib figures are only there for comparison
+    base = dict(flatten(baseline))
+    for key, value in flatten(results):
+        if key.startswith('stdlib.') or key not in base or not base[key]:
+            continue
+        if value > base[key] * (1 + threshold):
+            yield key, base[key], value
+
+def main(data_path=None, output=None, baseline=None, threshold=0.2, repeat=5):
+    zoneinfo = load_generated()
+    zones = [zoneinfo.timezones[name] for name in zoneinfo.timezones]
+    results = {
+        "python": platform.python_version(),
+        "zones": len(zones),
+        "import": time_import(repeat),
+        "calls": time_calls(zones, repeat),
+    }
+    if data_path is not None:
+        results["build"] = time_build(data_path, repeat)
+
+    stdlib = load_stdlib_zoneinfo()
+    if stdlib is not None:
+        system_zones = []
+        for name in zoneinfo.timezones:
+            try:
+                system_zones.append(stdlib.ZoneInfo(name))
+            except (stdlib.ZoneInfoNotFoundError, ValueError):
+                pass
+        if system_zones:
+            results["stdlib"] = {"zones": len(system_zones),
+                                 "calls": time_calls(system_zones, repeat)}
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as outf:
+            outf.write(text + '\n')
+
+    if baseline is not None:
+        with open(baseline) as inf:
+            slower = list(regressions(results, json.load(inf), threshold))
+        for key, before, after in slower:
+            sys.stderr.write("%s: %.6g -> %.6g (+%.0f%%)\n"
+                             % (key, before, after, (after / before - 1) * 100))
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data", metavar="PATH",
+                        help="also time building from the zoneinfo data files in PATH")
+    parser.add_argument("--output", "-o", metavar="FILE",
+                        help="write the results to FILE rather than stdout")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="fail if any timing is slower than in this earlier result")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed slowdown against the baseline, as a fraction")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="times to repeat each measurement, keeping the best")
+
+    args = parser.parse_args()
+
+    main(args.data, args.output, args.baseline, args.threshold, args.repeat)
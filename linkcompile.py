@@ -37,33 +37,31 @@ class Link(ASO):
     def __init__(self, n):
         self.name = n
         self.code_name = None
-        self.linkfrom_code_name = None
-        self.linkto_code_name = None
+        self.target = None
 
+    # Links are entries in the generated _links table, mapping the link's
+    # name to the zone it stands for
     def render(self, level=0):
         yield('\n')
         yield(INDENT * level)
-        for x in self.linkfromcode_name.render(level):
-            yield(x)
-        yield(' = ')
-        for x in self.linkto_code_name.render(level):
-            yield(x)
-
-class Identifier(ASO):
-    def __init__(self, n):
-        self.name = n
-
-    def render(self, level=0):
-        yield(self.name)
+        yield('%r: %r,' % (self.name, self.target))
 
 def compile(links):
     all_links = {}
     for _, link in links.items():
 
-        link_o = Link(link['from'])
-        link_o.code_name = name_to_identifier(link['from'])
-        link_o.linkfromcode_name = Identifier(name_to_identifier(link['from']))
-        link_o.linkto_code_name = Identifier(name_to_identifier(link['to']))
+        link_o = Link(link.name)
+        link_o.code_name = name_to_identifier(link.name)
+
+        # Follow links to links through to the zone
+        target = link.target
+        seen = set([link.name])
+        while target in links:
+            if target in seen:
+                raise CompileError("Circular link: %r" % (link.name,))
+            seen.add(target)
+            target = links[target].target
+        link_o.target = target
 
-        all_links[link['from']] = link_o
+        all_links[link.name] = link_o
     return all_links
@@ -27,8 +27,13 @@ SOFTWARE.
 """
 
 import argparse
+import concurrent.futures
+import fnmatch
+import hashlib
 import os
+import pickle
 import sys
+import tempfile
 
 import parse
 import rulecompile
@@ -53,21 +58,168 @@ zoneinfo_files = ["africa",
                   #"systemv",
                  ]
 
-def main(zoneinfo_data_path):
+def parser_digest():
+    # Changes to the parser invalidate everything it has cached
+    with open(os.path.splitext(parse.__file__)[0] + '.py', 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+def parse_file(file_path, cache_dir=None):
+    # Each file is parsed on its own; with a cache directory the records are
+    # kept there under a hash of the file's contents, and only files whose
+    # contents changed are parsed again
+    if cache_dir is None:
+        return parse.parse(file_path)
+    try:
+        with open(file_path, 'rb') as f:
+            digest = hashlib.sha256(parser_digest() + f.read()).hexdigest()
+    except IOError:
+        return ({}, {}, {})
+    cache_path = os.path.join(cache_dir, digest + '.pickle')
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        pass
+    parsed = parse.parse(file_path)
+    # Workers may be writing the same entry at once, so each writes its own
+    # temporary file and moves it into place
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(parsed, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return parsed
+
+def merge(parsed):
+    # Combines the per file records in file order, as parsing them all into
+    # the same dicts would
+    zones, rules, links = {}, {}, {}
+    for file_zones, file_rules, file_links in parsed:
+        zones.update(file_zones)
+        for name, elements in file_rules.items():
+            rules.setdefault(name, []).extend(elements)
+        links.update(file_links)
+    return zones, rules, links
+
+def compile_zones(zones, rulesets, horizon, until, since):
+    return zonecompile.compile(dict(zones), rulesets, horizon, until, since)
+
+def resolve_link(links, name):
+    # Follows a link, and any links it leads to, through to a zone name
+    seen = set()
+    while name in links and name not in seen:
+        seen.add(name)
+        name = links[name].target
+    return name
+
+def subset(zones, rules, links, patterns):
+    # Keeps the zones matching any of the patterns, directly or through a
+    # link, along with the rule sets they use and the links leading to them
+    selected = set()
+    for pattern in patterns:
+        matched = [name for name in zones if fnmatch.fnmatchcase(name, pattern)]
+        matched += [resolve_link(links, name) for name in links
+                    if fnmatch.fnmatchcase(name, pattern)]
+        matched = [name for name in matched if name in zones]
+        if not matched:
+            sys.stderr.write("No zones match %r\n" % (pattern,))
+            sys.exit(1)
+        selected.update(matched)
+
+    used_rules = set(line.rules for name in selected for line in zones[name].lines)
+    return (dict((name, zone) for name, zone in zones.items() if name in selected),
+            dict((name, rule) for name, rule in rules.items() if name in used_rules),
+            dict((name, link) for name, link in links.items()
+                 if resolve_link(links, name) in selected))
+
+def dedup(zonesets, linksets):
+    # Zones which compile to the same thing are written once, under the first
+    # of their names; the others become links to it, as do links to them.
+    # Returns the names merged away.
+    canonical = {}
+    for name in sorted(zonesets):
+        canonical.setdefault(zonesets[name].signature(), name)
+    merged = {}
+    for name, z in list(zonesets.items()):
+        target = canonical[z.signature()]
+        if target != name:
+            link = linkcompile.Link(name)
+            link.code_name = z.code_name
+            link.target = target
+            linksets[name] = link
+            merged[name] = target
+            del zonesets[name]
+    for _, l in linksets.items():
+        l.target = merged.get(l.target, l.target)
+    return merged
+
+def main(zoneinfo_data_path, package=False, binary=False, cache_dir=None, jobs=1,
+         stats=False, patterns=None, since=None, until=None,
+         horizon=zonecompile.HORIZON_YEAR, merge_identical=True, verbose=False):
     if not os.path.exists(zoneinfo_data_path):
         sys.stderr.write("Path does not exist\n")
         sys.exit(1)
+    if since is not None and until is not None and since > until:
+        sys.stderr.write("--since must not be after --until\n")
+        sys.exit(1)
+
+    paths = [os.path.join(zoneinfo_data_path, x) for x in zoneinfo_files]
+    # Files and zones are independent, so with jobs they are handled in a
+    # process pool; results are merged in the same order as a serial build,
+    # so the output is identical
+    pool = concurrent.futures.ProcessPoolExecutor(jobs) if jobs > 1 else None
+    try:
+        if pool is not None:
+            parsed = pool.map(parse_file, paths, [cache_dir] * len(paths))
+        else:
+            parsed = (parse_file(x, cache_dir) for x in paths)
+        zones, rules, links = merge(parsed)
+        if patterns:
+            zones, rules, links = subset(zones, rules, links, patterns)
 
-    zones = {}
-    rules = {}
-    links = {}
-    for file_path in [os.path.join(zoneinfo_data_path, x) for x in zoneinfo_files]:
-        zones, rules, links = parse.parse(file_path, zones, rules, links)
+        # Zones are resolved against their rules, so everything has to be
+        # parsed before compiling
         rulesets = rulecompile.compile(rules)
-        zonesets = zonecompile.compile(zones)
-        linksets = linkcompile.compile(links)
+        if pool is not None:
+            items = list(zones.items())
+            size = max(1, -(-len(items) // (jobs * 4)))
+            chunks = [items[i:i + size] for i in range(0, len(items), size)]
+            zonesets = {}
+            for compiled in pool.map(compile_zones, chunks, [rulesets] * len(chunks),
+                                     [horizon] * len(chunks), [until] * len(chunks),
+                                     [since] * len(chunks)):
+                zonesets.update(compiled)
+        else:
+            zonesets = zonecompile.compile(zones, rulesets, horizon, until, since)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    linksets = linkcompile.compile(links)
+
+    # History outside the years asked for is clamped, after compiling so
+    # that the periods at the edges are still worked out exactly
+    for _, z in zonesets.items():
+        z.prune(since, until)
+
+    if merge_identical:
+        total = len(zonesets)
+        merged = dedup(zonesets, linksets)
+        if verbose:
+            sys.stderr.write("Merged %d of %d zones into identical ones, writing %d\n"
+                             % (len(merged), total, len(zonesets)))
+            for name, target in sorted(merged.items()):
+                sys.stderr.write("    %s -> %s\n" % (name, target))
 
-    render.write_zonefile("northamerica", rulesets, zonesets, linksets)
+    if binary:
+        render.write_binary("northamerica", rulesets, zonesets, linksets, stats)
+    elif package:
+        render.write_package("northamerica", rulesets, zonesets, linksets, stats)
+    else:
+        render.write_zonefile("northamerica", rulesets, zonesets, linksets, stats)
 
 if __name__ == "__main__":
 
@@ -75,8 +227,44 @@ if __name__ == "__main__":
 
     parser.add_argument("path", nargs=1,
                         help="path to the zoneinfo data files")
+    parser.add_argument("--package", action="store_true",
+                        help="write a zoneinfo package with one module per zone")
+
+    parser.add_argument("--binary", action="store_true",
+                        help="write the zone tables to zoneinfo.zdb, read by a small zoneinfo.py")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="keep parsed files in DIR and only parse changed files again")
+    parser.add_argument("--jobs", "-j", type=int, default=1, metavar="N",
+                        help="parse files and compile zones in N processes")
+    parser.add_argument("--stats", action="store_true",
+                        help="count lookups, rule evaluations and cache use, reported by stats()")
+    parser.add_argument("--zone", action="append", default=[], metavar="PATTERN",
+                        help="only build zones matching PATTERN (a name or glob, may repeat)")
+    parser.add_argument("--zone-list", metavar="FILE",
+                        help="only build zones matching the patterns in FILE, one per line")
+    parser.add_argument("--since", type=int, metavar="YEAR",
+                        help="clamp times before YEAR to the period in effect at its start")
+    parser.add_argument("--until", type=int, metavar="YEAR",
+                        help="clamp times after YEAR to the period in effect at its end")
+    parser.add_argument("--horizon", type=int, default=zonecompile.HORIZON_YEAR, metavar="YEAR",
+                        help="precompute transitions through YEAR; later ones come from "
+                             "the recurring rules (default %(default)s)")
+
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="write every zone, even those identical to another")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="list the zones merged into identical ones")
 
     args = parser.parse_args()
 
-    main(args.path[0])
+    patterns = list(args.zone)
+    if args.zone_list:
+        with open(args.zone_list) as f:
+            patterns.extend(line.strip() for line in f
+                            if line.strip() and not line.startswith('#'))
+
+    main(args.path[0], package=args.package, binary=args.binary, cache_dir=args.cache,
+         jobs=args.jobs, stats=args.stats, patterns=patterns, since=args.since,
+         until=args.until, horizon=args.horizon, merge_identical=not args.no_dedup,
+         verbose=args.verbose)
 
@@ -24,160 +24,187 @@ SOFTWARE.
 
 """
 
-from datetime import datetime
-import re
-
-LAST_ZONE_SENT = '__last_processed_zone__'
-zone_re = re.compile(r'\A(Zone)\s([a-zA-Z0-9/_+-]+)\s+(-?\d{1,2}:?\d{0,2}:?\d{0,2})\s(-|[a-zA-Z0-9/_+\-]+)\s+(".*"|[\w+%-]+)\s?(\d{4} ?\w{0,3} *\d{0,2} *\d{0,2}:?\d{0,2}:?\d{0,2}[us]?)?$')
-			#-5:00	US	E%sT	1920
-zone_cont_re = re.compile(r'\A\s*(-?\d{1,2}:?\d{0,2}:?\d{0,2})\s*(\d:\d\d|-|[a-zA-Z0-9/_+\-]+)?\s(".*"|[\w+%/-]+)\s?(\d{4} ?\w{0,3} *[0-9a-zA-Z>=]* *\d{0,2}:?\d{0,2}:?\d{0,2}[us]?)?$')
-link_re = re.compile(r'\A(Link)\s([a-zA-Z0-9/_+\-]+)\s+([a-zA-Z0-9/_+\-]+)$')
-rule_re = re.compile(r'\A(Rule)\s([\w-]+)\s(\d+|min)\s(\d{4}|max|only)\s(.+)\s(\w+)\s(.+)\s([\w:-]+)\s([\w:-]+)\s([\w-]+)$')
+KEYWORDS = ('Rule', 'Zone', 'Link')
+MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
 
 class ParseError(Exception):
     pass
 
-def parse_rule(line, rules):
-    match = rule_re.match(line)
-
-    if not match:
-        raise ParseError("Unable to parse rule: %r" % (line,))
-
-    parts = match.groups()
-
-    if parts[0] != "Rule":
-        raise ParseError("parse mismatch, expecting 'Rule', got %r" % (parts[0],))
-
-    try:
-        this_rule = {
-                     "name":    parts[1],
-                     "from":    parts[2],
-                     "to":      parts[3],
-                     "type":    parts[4],
-                     "in":      parts[5],
-                     "on":      parts[6],
-                     "at":      parts[7],
-                     "save":    parts[8],
-                     "letter":  parts[9],
-                    }
-
-    except IndexError:
-        raise ParseError("not enough elements in this line to parse a rule: %r" % (line,))
-
-    name = this_rule['name']
-
-    try:
-        rules[name].append(this_rule)
-
-    except KeyError:
-        rules[name] = [this_rule]
-
-def parse_zone(line, zones):
-
-    if not line.startswith("Zone"):
-        match = zone_cont_re.match(line)
-
-        if not match:
-            raise ParseError("Unable to parse continuation line: %r" % (line,))
-
-        parts = match.groups()
-        offset = {
-                  "gmtoff": parts[0],
-                  "rules": parts[1],
-                  "format": parts[2],
-                  "until": parts[3],
-                 }
-
-        this_zone = zones[LAST_ZONE_SENT]
-        this_zone['offsets'].append(offset)
-
-    else:
-        match = zone_re.match(line)
-
-        if not match:
-            raise ParseError("Unable to parse zone line: %r" % (line,))
-
-        parts = match.groups()
-        this_zone = {
-                     "name": parts[1],
-                     "offsets": [
-                                 {"gmtoff": parts[2],
-                                  "rules": parts[3],
-                                  "format": parts[4],
-                                  "until": parts[5],
-                                 },
-                                ],
-                    }
-
-    name = this_zone['name']
-
-    zones[LAST_ZONE_SENT] = this_zone
-
-    zones[name] = this_zone
-
-
-def parse_link(line, links):
-    match = link_re.match(line)
-
-    if not match:
-        raise ParseError("Unable to parse link line: %r" % (line,))
-
-    parts = match.groups()
-
-    if parts[0] != "Link":
-        raise ParseError("parse mismatch, expecting 'Link', got %r" % (parts[0],))
-
-    try:
-        this_link = {
-                     "to":    parts[1],
-                     "from":      parts[2],
-                    }
-
-    except IndexError:
-        raise ParseError("not enough elements in this line to parse a link: %r" % (line,))
-
-    name = this_link['from']
-
-    links[name] = this_link
-
-def parse(f_path, zones={}, rules={}, links={}):
-
-    try:
-        with open(f_path, 'r') as zi_file:
-            last = None
-            for line in zi_file:
-
-                if '#' in line:
-                    line = line[:line.find('#')]
-
-                line = line.strip()
-
-                if not line:
+# Field checks: each raises ValueError for a value that can't be right
+def from_year(field):
+    if field != 'min' and not field.isdigit():
+        raise ValueError("bad FROM year %r" % (field,))
+
+def to_year(field):
+    if field not in ('only', 'max') and not field.isdigit():
+        raise ValueError("bad TO year %r" % (field,))
+
+def month(field):
+    if field[:3] not in MONTH_NAMES:
+        raise ValueError("bad month %r" % (field,))
+
+def time(field):
+    # The full syntax is checked when compiling
+    if not field.lstrip('-')[:1].isdigit():
+        raise ValueError("bad time %r" % (field,))
+
+class Record(object):
+    # Records remember the file and line they came from, for error messages
+    __slots__ = ('filename', 'lineno')
+    size = 0
+    checks = ()
+
+    @classmethod
+    def build(cls, values, filename, lineno):
+        if len(values) != cls.size:
+            raise ParseError("%s:%d: expected %d fields for %s, got %d"
+                             % (filename, lineno, cls.size, cls.__name__, len(values)))
+        try:
+            for i, check in cls.checks:
+                check(values[i])
+        except ValueError as e:
+            raise ParseError("%s:%d: %s" % (filename, lineno, e))
+        record = cls(*values)
+        record.filename = filename
+        record.lineno = lineno
+        return record
+
+    @property
+    def where(self):
+        return '%s:%d' % (self.filename, self.lineno)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join(repr(getattr(self, name)) for name in self.__slots__))
+
+class Rule(Record):
+    __slots__ = ('name', 'from_year', 'to_year', 'type', 'month', 'on', 'at', 'save', 'letter')
+    size = 9
+    checks = ((1, from_year), (2, to_year), (4, month), (6, time), (7, time))
+
+    def __init__(self, name, from_year, to_year, type, month, on, at, save, letter):
+        self.name = name
+        self.from_year = from_year
+        self.to_year = to_year
+        self.type = type
+        self.month = month
+        self.on = on
+        self.at = at
+        self.save = save
+        self.letter = letter
+
+class ZoneLine(Record):
+    __slots__ = ('gmtoff', 'rules', 'format', 'until')
+    size = 4
+
+    def __init__(self, gmtoff, rules, format, until):
+        self.gmtoff = gmtoff
+        self.rules = rules
+        self.format = format
+        self.until = until
+
+    @classmethod
+    def build(cls, values, filename, lineno):
+        # UNTIL is optional and spread over up to four fields
+        if len(values) < 3:
+            raise ParseError("%s:%d: expected at least 3 fields for a zone line, got %d"
+                             % (filename, lineno, len(values)))
+        try:
+            time(values[0])
+        except ValueError as e:
+            raise ParseError("%s:%d: %s" % (filename, lineno, e))
+        record = cls(values[0], values[1], values[2], ' '.join(values[3:]) or None)
+        record.filename = filename
+        record.lineno = lineno
+        return record
+
+class Zone(Record):
+    __slots__ = ('name', 'lines')
+    size = 2
+
+    def __init__(self, name, lines):
+        self.name = name
+        self.lines = lines
+
+class Link(Record):
+    __slots__ = ('target', 'name')
+    size = 2
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+
+def tokens(line):
+    # Whitespace separated fields up to a comment; double quotes group a
+    # field that contains either. Split on the quotes, the line alternates
+    # between unquoted and quoted parts, so a line without any is one part.
+    fields = []
+    attached = False
+    for i, part in enumerate(line.split('"')):
+        if i % 2:
+            if attached:
+                fields[-1] += part
+            else:
+                fields.append(part)
+            attached = True
+            continue
+        text, comment, _ = part.partition('#')
+        words = text.split()
+        if words and attached and not text[0].isspace():
+            fields[-1] += words.pop(0)
+        fields.extend(words)
+        if comment:
+            break
+        if text:
+            attached = not text[-1].isspace()
+    return fields
+
+def records(f_path):
+    # Yields the Rule, Zone and Link records of a file in order. A Zone comes
+    # with all of its continuation lines, so it's yielded once they end.
+    zone = None
+    with open(f_path, 'r') as zi_file:
+        for lineno, line in enumerate(zi_file, 1):
+            fields = tokens(line)
+            if not fields:
+                continue
+            if zone is not None:
+                if zone.lines[-1].until is not None and fields[0] not in KEYWORDS:
+                    zone.lines.append(ZoneLine.build(fields, f_path, lineno))
                     continue
-
-                if line.startswith("Rule"):
-                    parse_rule(line, rules)
-                    last = "Rule"
-
-                elif line.startswith("Zone"):
-                    parse_zone(line, zones)
-                    last = "Zone"
-
-                elif line.startswith("Link"):
-                    parse_link(line, links)
-                    last = "Link"
-
-                elif last == "Zone":
-                    parse_zone(line, zones)
-                    last="Zone"
-
-                else:
-                    raise ParseError("I don't know how to parse %r" % (line,))
-
+                yield zone
+                zone = None
+
+            kind = fields[0]
+            if kind == 'Rule':
+                yield Rule.build(fields[1:], f_path, lineno)
+            elif kind == 'Zone':
+                if len(fields) < 2:
+                    raise ParseError("%s:%d: zone without a name" % (f_path, lineno))
+                zone = Zone.build([fields[1], [ZoneLine.build(fields[2:], f_path, lineno)]],
+                                  f_path, lineno)
+            elif kind == 'Link':
+                yield Link.build(fields[1:], f_path, lineno)
+            else:
+                raise ParseError("%s:%d: I don't know how to parse %r"
+                                 % (f_path, lineno, line.strip()))
+    if zone is not None:
+        yield zone
+
+def parse(f_path, zones=None, rules=None, links=None):
+    # Collects the records of a file by name; rules are listed per rule set
+    zones = {} if zones is None else zones
+    rules = {} if rules is None else rules
+    links = {} if links is None else links
+    try:
+        for record in records(f_path):
+            if isinstance(record, Rule):
+                rules.setdefault(record.name, []).append(record)
+            elif isinstance(record, Zone):
+                zones[record.name] = record
+            else:
+                links[record.name] = record
     except IOError:
         pass
 
-    if LAST_ZONE_SENT in zones:
-        del(zones[LAST_ZONE_SENT])
-
     return (zones, rules, links)
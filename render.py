@@ -24,7 +24,11 @@ SOFTWARE.
 """
 
 import os
+import sys
+import shutil
+import struct
 import datetime
+from array import array
 
 license = """
 Copyright (c) %d Garrick Peterson
@@ -52,156 +56,908 @@ PKG_NAME = 'zoneinfo'
 GENERATOR_URL = "https://github.com/garrickp/tzinfo_py"
 
 HELPER_FUNCS = """
-# Support functions for rules that rely on calendar days
-def __lastSun(year, month, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in reversed(c):
-        day = w[6]
-        if day != 0:
-            break
-    return datetime(year, month, day, hour, min)
-def __lastSat(year, month, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in reversed(c):
-        day = w[5]
-        if day != 0:
-            break
-    return datetime(year, month, day, hour, min)
-def __lastFri(year, month, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in reversed(c):
-        day = w[4]
-        if day != 0:
-            break
-    return datetime(year, month, day, hour, min)
-def __lastThu(year, month, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in reversed(c):
-        day = w[3]
-        if day != 0:
-            break
-    return datetime(year, month, day, hour, min)
-def __lastWed(year, month, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in reversed(c):
-        day = w[2]
-        if day != 0:
-            break
-    return datetime(year, month, day, hour, min)
-def __lastTue(year, month, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in reversed(c):
-        day = w[1]
-        if day != 0:
-            break
-    return datetime(year, month, day, hour, min)
-def __lastMon(year, month, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in reversed(c):
-        day = w[0]
-        if day != 0:
-            break
-    return datetime(year, month, day, hour, min)
-def __SunGtEq(year, month, min_day, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in c:
-        day = w[6]
-        if day >= min_day:
-            break
-    return datetime(year, month, day, hour, min)
-def __SatGtEq(year, month, min_day, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in c:
-        day = w[5]
-        if day >= min_day:
-            break
-    return datetime(year, month, day, hour, min)
-def __FriGtEq(year, month, min_day, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in c:
-        day = w[4]
-        if day >= min_day:
-            break
-    return datetime(year, month, day, hour, min)
-def __ThuGtEq(year, month, min_day, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in c:
-        day = w[3]
-        if day >= min_day:
-            break
-    return datetime(year, month, day, hour, min)
-def __WedGtEq(year, month, min_day, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in c:
-        day = w[2]
-        if day >= min_day:
-            break
-    return datetime(year, month, day, hour, min)
-def __TueGtEq(year, month, min_day, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in c:
-        day = w[1]
-        if day >= min_day:
-            break
-    return datetime(year, month, day, hour, min)
-def __MonGtEq(year, month, min_day, hour, min):
-    c = Calendar().monthdayscalendar(year, month)
-    day = 0
-    for w in c:
-        day = w[0]
-        if day >= min_day:
-            break
-    return datetime(year, month, day, hour, min)
-
-# Constant rules
-def _rule_constant_1hour(dt):
-    return (timedelta(hours=1), '')
-def _rule_constant_30min(dt):
-    return (timedelta(minutes=30), '')
-def _rule_constant_20min(dt):
-    return (timedelta(minutes=20), '')
+# Support functions for rules that rely on calendar days. Days are found with
+# ordinal arithmetic (as date.toordinal() counts them) rather than building
+# calendars; _GE and _LE pick the given weekday on or after / on or before the
+# given day, _LAST the last such weekday of the month.
+_EPOCH_ORDINAL = 719163
+_DAY, _LAST, _GE, _LE = 0, 1, 2, 3
+_DAYS_BEFORE_MONTH = (0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365)
 
+def _ordinal(year, month, day):
+    #@stats calls '_ordinal'
+    y = year - 1
+    o = y * 365 + y // 4 - y // 100 + y // 400 + _DAYS_BEFORE_MONTH[month] + day
+    if month > 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        o += 1
+    return o
+
+def _rule_ordinal(year, month, kind, weekday, day):
+    #@stats calls '_rule_ordinal'
+    if kind == _LAST:
+        o = _ordinal(year, month + 1, 0)
+        return o - ((o + 6) % 7 - weekday) % 7
+    o = _ordinal(year, month, day)
+    if kind == _GE:
+        return o + (weekday - (o + 6) % 7) % 7
+    if kind == _LE:
+        return o - ((o + 6) % 7 - weekday) % 7
+    return o
+
+def _year_of(secs):
+    # Year of a number of seconds since the epoch
+    o = secs // 86400 + _EPOCH_ORDINAL
+    year = o * 400 // 146097 + 1
+    while _ordinal(year, 1, 1) > o:
+        year -= 1
+    while _ordinal(year + 1, 1, 1) <= o:
+        year += 1
+    return year
+
+# Periods, as (offset, save, abbreviation, offset seconds), are pooled: zones
+# and tails with the same period share one tuple, and every period with a
+# given offset or save the same timedelta
+_timedelta_pool = {}
+_period_pool = {}
+
+def _timedelta(secs):
+    try:
+        return _timedelta_pool[secs]
+    except KeyError:
+        return _timedelta_pool.setdefault(secs, timedelta(seconds=secs))
+
+def _period(offset, save, abbr):
+    key = (offset, save, abbr)
+    try:
+        return _period_pool[key]
+    except KeyError:
+        return _period_pool.setdefault(key, (_timedelta(offset), _timedelta(save),
+                                             _sys.intern(abbr), offset))
+
+# Past the end of its transition table a zone follows its rules year by year,
+# given much as in a POSIX TZ string but with tzdata's ON forms and AT types:
+# (month, kind, weekday, day, at seconds, at type, save seconds, abbreviation).
+# The rules come in spans of years, as (first year, rules) pairs, and a year
+# takes the rules of the span it falls in; years before the first span take
+# its rules too. Spans other than the first and last may have no rules. Each year's transitions are worked out once, in UTC seconds,
+# and kept in a small per zone LRU cache.
+RULE_CACHE_SIZE = 4
+
+class _RecurringTail(object):
+    instances = []
+    maxsize = RULE_CACHE_SIZE
+
+    def __init__(self, name, stdoff, spans):
+        self.name = name
+        self.stdoff = stdoff
+        self.years = tuple(year for year, _ in spans)
+        self.spans = tuple(tuple((rule[:6], _period(stdoff + rule[6], rule[6], rule[7]))
+                                 for rule in rules)
+                           for _, rules in spans)
+        self.cache = OrderedDict()
+        self.last = (0, 0, None)
+        _RecurringTail.instances.append(self)
+
+    def _local_transitions(self, year):
+        #@stats rule_years self.name
+        rules = self.spans[max(bisect_right(self.years, year) - 1, 0)]
+        return sorted(((_rule_ordinal(year, month, kind, weekday, day) - _EPOCH_ORDINAL) * 86400
+                       + at, at_type, period)
+                      for (month, kind, weekday, day, at, at_type), period in rules)
+
+    def transitions(self, year):
+        # The transitions from the last of the year before to the first of
+        # the year after, as UTC instants, their wall times for fold=0 and
+        # fold=1, and the periods before the first and after each one
+        cache = self.cache
+        try:
+            found = cache[year]
+            cache.move_to_end(year)
+            #@stats rule_cache 'hits'
+            return found
+        except KeyError:
+            pass
+        #@stats rule_cache 'misses'
+        local = (self._local_transitions(year - 1) + self._local_transitions(year)
+                 + self._local_transitions(year + 1))
+        # The periods follow on from the one in effect at the end of year - 2,
+        # left by the last year before it with any transitions. Years before
+        # the first span have its rules, which are never empty.
+        previous = year - 2
+        found = self._local_transitions(previous)
+        while not found:
+            previous -= 1
+            found = self._local_transitions(previous)
+        before = found[-1][2]
+        ats, walls, periods = [], ([], []), []
+        for at, at_type, after in local:
+            if at_type == 'w':
+                at -= before[3]
+            elif at_type == 's':
+                at -= self.stdoff
+            ats.append(at)
+            walls[0].append(at + max(before[3], after[3]))
+            walls[1].append(at + min(before[3], after[3]))
+            periods.append(before)
+            before = after
+        periods.append(before)
+        found = cache[year] = (ats, walls, periods)
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return found
+
+    def year_transitions(self, ts):
+        # The transitions for the year ts falls in. The bounds of the last
+        # year used, in seconds, are checked first so that the year is only
+        # worked out when ts falls outside it; they are swapped in as one
+        # tuple, so concurrent callers always see a consistent set.
+        start, end, found = self.last
+        if start <= ts < end:
+            return found
+        year = _year_of(ts)
+        found = self.transitions(year)
+        self.last = ((_ordinal(year, 1, 1) - _EPOCH_ORDINAL) * 86400,
+                     (_ordinal(year + 1, 1, 1) - _EPOCH_ORDINAL) * 86400, found)
+        return found
+
+    def utc(self, ts):
+        # The period in effect at UTC instant ts, and whether the wall time
+        # there is the second occurrence of a repeated one
+        #@stats rulesets self.name
+        ats, walls, periods = self.year_transitions(ts)
+        i = bisect_right(ats, ts)
+        period = periods[i]
+        return period, i and ts + period[3] < walls[0][i - 1]
+
+    def wall(self, ts, fold):
+        # The period in effect at wall time ts, and its span (see
+        # _period_span) or None where the year's transitions don't bound it
+        #@stats rulesets self.name
+        ats, walls, periods = self.year_transitions(ts)
+        i = bisect_right(walls[fold], ts)
+        if 0 < i < len(ats):
+            return periods[i], _period_span(ats, walls, i, periods[i], -_NO_TAIL, _NO_TAIL)
+        return periods[i], None
+
+    def local(self, ts):
+        # The UTC offsets fold=0 and fold=1 give for wall time ts, and the
+        # transition between them when they differ
+        #@stats rulesets self.name
+        ats, walls, periods = self.year_transitions(ts)
+        i = bisect_right(walls[0], ts)
+        j = bisect_right(walls[1], ts)
+        return (periods[i][3], periods[j][3], ats[i] if i < j else 0)
+
+def set_rule_cache_size(size):
+    _RecurringTail.maxsize = size
+    for r in _RecurringTail.instances:
+        while len(r.cache) > size:
+            r.cache.popitem(last=False)
+        r.last = (0, 0, None)
+
+"""
+
+IMPORTS = """from array import array
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+from datetime import tzinfo, datetime, timedelta
+from time import time as _time
+import sys as _sys
 """
 
-def write_zonefile(name, rulesets, zonesets, linksets):
-    with open("zoneinfo.py", 'w') as outf:
-        outf.write('"""\n')
-        outf.write("generated %s file\n\n" % (PKG_NAME,))
-        outf.write("Generated from: %s\n" % (GENERATOR_URL,))
-        outf.write(license)
-        outf.write('"""\n\n')
-        outf.write('from datetime import tzinfo, datetime, timedelta\n')
-        outf.write('from calendar import Calendar\n')
-        outf.write(HELPER_FUNCS)
-
-        outf.write("# Rule sets")
-        for _, r in rulesets.items():
-            outf.writelines((str(x) for x in r.render()))
-        outf.write("\n# Zones sets")
+LOOKUP_FUNCS = """
+# Period lookups against the compiled transition tables
+_NO_TAIL = 1 << 62
+
+def _wall_seconds(dt):
+    return ((dt.toordinal() - _EPOCH_ORDINAL) * 86400
+            + dt.hour * 3600 + dt.minute * 60 + dt.second)
+
+# Each zone keeps the span of the period it last found, as (wall start, wall
+# end, utc start, utc end, period), and answers times inside it straight
+# away. Inside the span the period is the same whatever the fold. Spans are
+# replaced whole, so threads sharing a zone never see parts of two.
+_NO_SPAN = (0, 0, 0, 0, None)
+
+def _period_span(ats, walls, i, period, lo, hi):
+    # The span of the period between transitions i - 1 and i, cut to lo, hi
+    if i:
+        wall_start, utc_start = walls[0][i - 1], walls[0][i - 1] - period[3]
+    else:
+        wall_start = utc_start = lo
+    if i < len(ats):
+        wall_end, utc_end = walls[1][i], ats[i]
+    else:
+        wall_end = utc_end = hi
+    return (max(wall_start, lo), min(wall_end, hi), max(utc_start, lo), min(utc_end, hi),
+            period)
+
+def _table_span(zone, i):
+    return _period_span(zone._trans_utc, zone._trans_wall, i, zone._periods[zone._trans_idx[i]],
+                        -_NO_TAIL, zone._tail_start)
+
+# Each zone keeps the periods found for its most recently used wall times, to
+# the second, so utcoffset(), dst() and tzname() of one datetime only look the
+# period up once
+PERIOD_CACHE_SIZE = 16
+_PeriodCacheInfo = namedtuple('PeriodCacheInfo', 'hits misses maxsize currsize')
+_period_caches = []
+_period_stats = [0, 0, PERIOD_CACHE_SIZE]
+
+def set_period_cache_size(size):
+    _period_stats[2] = size
+    for cache in _period_caches:
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+def period_cache_info():
+    return _PeriodCacheInfo(_period_stats[0], _period_stats[1], _period_stats[2],
+                            sum(len(cache) for cache in _period_caches))
+
+def _find_period(zone, dt):
+    #@stats zones type(zone).__name__
+    if dt is None:
+        now = int(_time())
+        current = zone._current
+        if current[2] <= now < current[3]:
+            return current[4]
+        if now >= zone._tail_start:
+            return zone._tail.utc(now)[0]
+        return zone._periods[zone._trans_idx[bisect_right(zone._trans_utc, now)]]
+    ts = _wall_seconds(dt)
+    current = zone._current
+    if current[0] <= ts < current[1]:
+        _period_stats[0] += 1
+        #@stats period_cache 'hits'
+        return current[4]
+    key = ts * 2 + dt.fold
+    cache = zone._cache
+    if cache is None:
+        cache = type(zone)._cache = OrderedDict()
+        _period_caches.append(cache)
+    try:
+        found = cache[key]
+        cache.move_to_end(key)
+        _period_stats[0] += 1
+        #@stats period_cache 'hits'
+        return found
+    except KeyError:
+        pass
+    _period_stats[1] += 1
+    #@stats period_cache 'misses'
+    if ts >= zone._tail_start:
+        found, current = zone._tail.wall(ts, dt.fold)
+        if current is not None:
+            type(zone)._current = current
+    else:
+        i = bisect_right(zone._trans_wall[dt.fold], ts)
+        found = zone._periods[zone._trans_idx[i]]
+        type(zone)._current = _table_span(zone, i)
+    cache[key] = found
+    while len(cache) > _period_stats[2]:
+        cache.popitem(last=False)
+    return found
+
+def _from_utc(zone, dt):
+    #@stats calls '_from_utc'
+    if not isinstance(dt, datetime):
+        raise TypeError("fromutc() requires a datetime argument")
+    if dt.tzinfo is not zone:
+        raise ValueError("dt.tzinfo is not self")
+    ts = _wall_seconds(dt)
+    current = zone._current
+    if current[2] <= ts < current[3]:
+        return dt + current[4][0]
+    # Just after the clocks go back, wall times repeat: that's the second
+    # occurrence, so fold is set
+    if ts >= zone._tail_start:
+        period, fold = zone._tail.utc(ts)
+        offset = period[0]
+        current = zone._tail.wall(ts + period[3], fold)[1]
+        if current is not None:
+            type(zone)._current = current
+    else:
+        i = bisect_right(zone._trans_utc, ts)
+        offset, _, _, offset_secs = zone._periods[zone._trans_idx[i]]
+        fold = i and ts + offset_secs < zone._trans_wall[0][i - 1]
+        type(zone)._current = _table_span(zone, i)
+    if fold:
+        return (dt + offset).replace(fold=1)
+    return dt + offset
+
+"""
+
+# Instrumented builds count events in the runtime, marked in the code above
+# and below with '#@stats <group> <key>' lines; other builds leave them out
+STATS_FUNCS = """
+# Counts of zone lookups, rule set evaluations, years worked out from rules,
+# helper calls and cache use
+from collections import Counter as _Counter
+
+_stats = dict((group, _Counter()) for group in
+              ('lookups', 'zones', 'rulesets', 'rule_years', 'calls', 'period_cache',
+               'rule_cache'))
+
+def stats():
+    return dict((group, dict(counts)) for group, counts in _stats.items())
+
+def reset_stats():
+    for counts in _stats.values():
+        counts.clear()
+"""
+
+BATCH_FUNCS = """
+# Batch conversion of UTC instants, as seconds since the epoch or numpy
+# datetime64 values. Returns the UTC offsets in seconds, DST flags, and
+# indices into the list of abbreviations returned with them. numpy arrays are
+# searched in one go with numpy, and values past the precomputed transitions
+# once per year against that year's tail transitions; anything else is
+# converted to lists.
+_EPOCH = datetime(1970, 1, 1)
+
+def _is_ndarray(values):
+    # numpy is never imported here, as that is slow; anyone passing an array
+    # has imported it already
+    np = _sys.modules.get('numpy')
+    return np is not None and isinstance(values, np.ndarray)
+
+def _utc_offsets(zone, timestamps):
+    #@stats calls '_utc_offsets'
+    names = []
+    def name_index(name):
+        if name not in names:
+            names.append(name)
+        return names.index(name)
+    def row(p):
+        return (p[3], bool(p[1]), name_index(p[2]))
+    periods = [row(p) for p in zone._periods]
+    if _is_ndarray(timestamps):
+        return _utc_offsets_numpy(zone, timestamps, periods, row) + (names,)
+    offsets, dst, abbrs = [], [], []
+    trans_utc, trans_idx, tail_start = zone._trans_utc, zone._trans_idx, zone._tail_start
+    for ts in timestamps:
+        if ts >= tail_start:
+            p = row(zone._tail.utc(ts)[0])
+        else:
+            p = periods[trans_idx[bisect_right(trans_utc, ts)]]
+        offsets.append(p[0])
+        dst.append(p[1])
+        abbrs.append(p[2])
+    return offsets, dst, abbrs, names
+
+def _tail_years(_np, zone, timestamps):
+    # The indices of the values past the precomputed transitions, grouped by
+    # year along with the tail's transitions for it, so that each year is
+    # searched in one go
+    past = _np.flatnonzero(timestamps >= zone._tail_start)
+    if not len(past):
+        return
+    years = timestamps[past].astype('datetime64[s]').astype('datetime64[Y]').astype(_np.int64)
+    for year in _np.unique(years):
+        yield past[years == year], zone._tail.transitions(int(year) + 1970)
+
+def _utc_offsets_numpy(zone, timestamps, periods, row):
+    _np = _sys.modules['numpy']
+    if timestamps.dtype.kind == 'M':
+        timestamps = timestamps.astype('datetime64[s]').astype(_np.int64)
+    trans_utc = _np.frombuffer(zone._trans_utc, dtype=_np.int64)
+    trans_idx = _np.frombuffer(zone._trans_idx, dtype=_np.uint16)
+    found = _np.array(periods, dtype=_np.int64)[
+        trans_idx[_np.searchsorted(trans_utc, timestamps, side='right')]]
+    for k, (ats, _, tail_periods) in _tail_years(_np, zone, timestamps):
+        rows = _np.array([row(p) for p in tail_periods], dtype=_np.int64)
+        found[k] = rows[_np.searchsorted(_np.array(ats, dtype=_np.int64), timestamps[k],
+                                         side='right')]
+    return found[:, 0], found[:, 1].astype(bool), found[:, 2]
+
+# Batch localization of naive wall times, as seconds since the epoch or numpy
+# datetime64 values, to UTC instants. Repeated wall times resolve to the
+# 'earlier' or 'later' instant; wall times skipped by the clocks going forward
+# either 'shift_forward' to the instant of the change or 'shift_backward' to
+# the second before it. Either policy can be 'raise' for a ValueError.
+_AMBIGUOUS = ('earlier', 'later', 'raise')
+_NONEXISTENT = ('shift_forward', 'shift_backward', 'raise')
+
+def _local_candidates(zone, t):
+    # The offsets fold=0 and fold=1 give for wall time t, and the transition
+    # between them when they differ
+    if t < zone._tail_start:
+        i = bisect_right(zone._trans_wall[0], t)
+        j = bisect_right(zone._trans_wall[1], t)
+        return (zone._periods[zone._trans_idx[i]][3], zone._periods[zone._trans_idx[j]][3],
+                zone._trans_utc[i] if i < j else 0)
+    return zone._tail.local(t)
+
+def _check_policies(ambiguous, nonexistent):
+    if ambiguous not in _AMBIGUOUS:
+        raise ValueError("ambiguous must be one of %s" % (', '.join(_AMBIGUOUS),))
+    if nonexistent not in _NONEXISTENT:
+        raise ValueError("nonexistent must be one of %s" % (', '.join(_NONEXISTENT),))
+
+def _policy_error(zone, t, what):
+    return ValueError("%s is %s in %s" % (_EPOCH + timedelta(seconds=int(t)), what,
+                                          type(zone).__name__))
+
+def _localize(zone, timestamps, ambiguous, nonexistent):
+    #@stats calls '_localize'
+    _check_policies(ambiguous, nonexistent)
+    if _is_ndarray(timestamps):
+        return _localize_numpy(zone, timestamps, ambiguous, nonexistent)
+    result = []
+    for t in timestamps:
+        o0, o1, changed = _local_candidates(zone, t)
+        if o0 > o1:
+            if ambiguous == 'raise':
+                raise _policy_error(zone, t, 'ambiguous')
+            result.append(t - (o0 if ambiguous == 'earlier' else o1))
+        elif o0 < o1:
+            if nonexistent == 'raise':
+                raise _policy_error(zone, t, 'nonexistent')
+            result.append(changed if nonexistent == 'shift_forward' else changed - 1)
+        else:
+            result.append(t - o0)
+    return result
+
+def _localize_numpy(zone, timestamps, ambiguous, nonexistent):
+    _np = _sys.modules['numpy']
+    datetimes = timestamps.dtype.kind == 'M'
+    if datetimes:
+        timestamps = timestamps.astype('datetime64[s]').astype(_np.int64)
+    offsets = _np.array([p[3] for p in zone._periods], dtype=_np.int64)
+    trans_idx = _np.frombuffer(zone._trans_idx, dtype=_np.uint16)
+    i = _np.searchsorted(_np.frombuffer(zone._trans_wall[0], dtype=_np.int64), timestamps, side='right')
+    j = _np.searchsorted(_np.frombuffer(zone._trans_wall[1], dtype=_np.int64), timestamps, side='right')
+    o0, o1 = offsets[trans_idx[i]], offsets[trans_idx[j]]
+    changed = _np.append(_np.frombuffer(zone._trans_utc, dtype=_np.int64), 0)[i]
+    for k, (ats, walls, tail_periods) in _tail_years(_np, zone, timestamps):
+        tail_offsets = _np.array([p[3] for p in tail_periods], dtype=_np.int64)
+        ti = _np.searchsorted(_np.array(walls[0], dtype=_np.int64), timestamps[k], side='right')
+        tj = _np.searchsorted(_np.array(walls[1], dtype=_np.int64), timestamps[k], side='right')
+        o0[k], o1[k] = tail_offsets[ti], tail_offsets[tj]
+        changed[k] = _np.where(ti < tj, _np.append(_np.array(ats, dtype=_np.int64), 0)[ti], 0)
+    repeated, skipped = o0 > o1, o0 < o1
+    if ambiguous == 'raise' and repeated.any():
+        raise _policy_error(zone, timestamps[_np.argmax(repeated)], 'ambiguous')
+    if nonexistent == 'raise' and skipped.any():
+        raise _policy_error(zone, timestamps[_np.argmax(skipped)], 'nonexistent')
+    result = timestamps - (_np.where(repeated, o1, o0) if ambiguous == 'later' else o0)
+    result = _np.where(skipped, changed if nonexistent == 'shift_forward' else changed - 1, result)
+    if datetimes:
+        return result.astype('datetime64[s]')
+    return result
+
+# Generated zone classes only hold their tables; the methods are all here
+class _Zone(tzinfo):
+    _cache = None
+    _current = _NO_SPAN
+
+    def utcoffset(self, dt):
+        return _find_period(self, dt)[0]
+
+    def dst(self, dt):
+        return _find_period(self, dt)[1]
+
+    def tzname(self, dt):
+        return _find_period(self, dt)[2]
+
+    def fromutc(self, dt):
+        return _from_utc(self, dt)
+
+    def utcoffsets(self, timestamps):
+        return _utc_offsets(self, timestamps)
+
+    def localize(self, timestamps, ambiguous='earlier', nonexistent='shift_forward'):
+        return _localize(self, timestamps, ambiguous, nonexistent)
+
+# Zones that only ever have one period need no lookups. Each distinct period
+# gets one such class, named after the period, and one shared instance of it,
+# which pickles as its period. The empty tables let the batch methods handle
+# them too.
+_fixed_zones = {}
+
+class _FixedZone(_Zone):
+    _instance = None
+    _trans_utc = array('q')
+    _trans_wall = (_trans_utc, _trans_utc)
+    _trans_idx = array('H', [0])
+    _tail_start = _NO_TAIL
+    _tail = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = tzinfo.__new__(cls)
+        return cls._instance
+
+    def utcoffset(self, dt):
+        #@stats zones type(self).__name__
+        return self._periods[0][0]
+
+    def dst(self, dt):
+        #@stats zones type(self).__name__
+        return self._periods[0][1]
+
+    def tzname(self, dt):
+        #@stats zones type(self).__name__
+        return self._periods[0][2]
+
+    def fromutc(self, dt):
+        if not isinstance(dt, datetime):
+            raise TypeError("fromutc() requires a datetime argument")
+        if dt.tzinfo is not self:
+            raise ValueError("dt.tzinfo is not self")
+        return dt + self._periods[0][0]
+
+    def __reduce__(self):
+        return (_fixed_instance, self._key)
+
+def _fixed_zone(offset, save, abbr):
+    key = (offset, save, abbr)
+    try:
+        return _fixed_zones[key]
+    except KeyError:
+        pass
+    name = '_Fixed_%s_%s' % (offset, abbr)
+    name = name.replace('-', 'minus').replace('+', 'plus')
+    return _fixed_zones.setdefault(key, type(name, (_FixedZone,), {
+        '__module__': __name__,
+        '__qualname__': name,
+        '_key': key,
+        '_periods': (_period(offset, save, abbr),),
+    }))
+
+def _fixed_instance(offset, save, abbr):
+    return _fixed_zone(offset, save, abbr)()
+
+
+"""
+
+REGISTRY_FUNCS = """
+# Zone classes are only created, and instantiated once, when first looked up
+class _Registry(Mapping):
+    def __init__(self, zones, links):
+        self._factories = zones
+        self._links = links
+        self._instances = {}
+
+    def __getitem__(self, name):
+        #@stats lookups name
+        try:
+            return self._instances[name]
+        except KeyError:
+            pass
+        target = self._links.get(name, name)
+        zone = self._instances.get(target)
+        if zone is None:
+            zone = self._instances.setdefault(target, self._factories[target]()())
+        return self._instances.setdefault(name, zone)
+
+    def __contains__(self, name):
+        return name in self._factories or name in self._links
+
+    def __iter__(self):
+        for name in self._factories:
+            yield name
+        for name in self._links:
+            yield name
+
+    def __len__(self):
+        return len(self._factories) + len(self._links)
+
+"""
+
+# Only written to the top level module, as it serves that module's classes
+MODULE_FUNCS = """
+def __getattr__(name):
+    # Zone classes by identifier, as they were when defined at module level
+    try:
+        return type(timezones[_code_names[name]])
+    except KeyError:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+"""
+
+# Package mode: the top level module loads each zone's submodule on demand
+LOADER_FUNCS = """
+def _zone_loader(code_name):
+    def load():
+        module = import_module('%s._zones.%s' % (__name__, code_name))
+        return getattr(module, '_zone_' + code_name)()
+    return load
+"""
+
+ZONE_IMPORTS = ('from .._runtime import array, _Zone, _NO_TAIL, _period, _RecurringTail, '
+                '_DAY, _LAST, _GE, _LE, _fixed_zone\n')
+
+# Binary mode: the zone tables go in a separate file which the generated
+# module maps into memory, so processes using the same file share its pages
+# and importing the module doesn't compile the tables. All values are little
+# endian; string and data offsets are relative to their sections.
+BINARY_MAGIC = b'TZPY'
+BINARY_VERSION = 3
+BINARY_HEADER = '<4sHHIIIIII'  # magic, version, reserved, zone count, link count,
+                               # periods, tail rules, strings and data section
+                               # offsets
+BINARY_ZONE = '<IIIIIIIIqiIIII'  # name, code name, transition count, period
+                                 # count, first period, data offset, tail start,
+                                 # tail stdoff, tail rule set name, first tail
+                                 # rule, tail rule count
+BINARY_LINK = '<IIIIII'  # name, code name, target
+BINARY_PERIOD = '<iiII'  # offset, save, abbreviation
+BINARY_RULE = '<HBBBBBxiiII'  # first year of its span, month, kind, weekday,
+                              # day, at type, at, save, abbreviation; month 0
+                              # stands for a span with no rules
+BINARY_AT_TYPES = 'wsu'
+
+BINARY_IMPORTS = """import mmap
+import os
+import struct
+import sys
+"""
+
+BINARY_FUNCS = """
+# Zone tables are read from the binary file next to this module. It is mapped
+# into memory and the transition arrays are views into the mapping, not copies.
+_BINARY_MAGIC = %r
+_BINARY_VERSION = %d
+_BINARY_HEADER = struct.Struct(%r)
+_BINARY_ZONE = struct.Struct(%r)
+_BINARY_LINK = struct.Struct(%r)
+_BINARY_PERIOD = struct.Struct(%r)
+_BINARY_RULE = struct.Struct(%r)
+_BINARY_AT_TYPES = %r
+
+class _ZoneFile(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        (magic, version, _, self.zone_count, self.link_count, self.periods_offset,
+         self.rules_offset, self.strings_offset, self.data_offset) = _BINARY_HEADER.unpack_from(self.map)
+        if magic != _BINARY_MAGIC or version != _BINARY_VERSION:
+            raise ValueError("%%s is not a version %%d zone file" %% (path, _BINARY_VERSION))
+        self.links_offset = _BINARY_HEADER.size + self.zone_count * _BINARY_ZONE.size
+
+    def string(self, offset, length):
+        offset += self.strings_offset
+        return str(self.view[offset:offset + length], 'utf-8')
+
+    def array(self, offset, count, typecode):
+        offset += self.data_offset
+        view = self.view[offset:offset + count * (8 if typecode == 'q' else 2)]
+        if sys.byteorder == 'little':
+            return view.cast(typecode)
+        a = array(typecode)
+        a.frombytes(view)
+        a.byteswap()
+        return a
+
+    def entry(self, index):
+        return _BINARY_ZONE.unpack_from(self.map, _BINARY_HEADER.size + index * _BINARY_ZONE.size)
+
+    def period(self, index):
+        offset, save, abbr_offset, abbr_length = _BINARY_PERIOD.unpack_from(
+            self.map, self.periods_offset + index * _BINARY_PERIOD.size)
+        return offset, save, self.string(abbr_offset, abbr_length)
+
+    def zone(self, index):
+        (_, _, code_offset, code_length, count, period_count, first_period, data,
+         tail_start, tail_stdoff, rule_offset, rule_length, first_rule,
+         rule_count) = self.entry(index)
+        if not count and not rule_count:
+            # One period for all time, see _fixed_zone()
+            return _fixed_zone(*self.period(first_period))
+        code_name = self.string(code_offset, code_length)
+        periods = tuple(_period(*self.period(i))
+                        for i in range(first_period, first_period + period_count))
+        if rule_count:
+            # A span's rules are stored together, each with its first year
+            spans = []
+            for i in range(first_rule, first_rule + rule_count):
+                (year, month, kind, weekday, day, at_type, at, save, abbr_offset,
+                 abbr_length) = _BINARY_RULE.unpack_from(self.map, self.rules_offset
+                                                         + i * _BINARY_RULE.size)
+                if not spans or spans[-1][0] != year:
+                    spans.append((year, []))
+                if not month:
+                    continue
+                spans[-1][1].append((month, kind, weekday, day, at, _BINARY_AT_TYPES[at_type],
+                                     save, self.string(abbr_offset, abbr_length)))
+            tail = _RecurringTail(self.string(rule_offset, rule_length), tail_stdoff, spans)
+        else:
+            tail = None
+        return type(code_name, (_Zone,), {
+            '__module__': __name__,
+            '__qualname__': code_name,
+            '_trans_utc': self.array(data, count, 'q'),
+            '_trans_wall': (self.array(data + count * 8, count, 'q'),
+                            self.array(data + count * 16, count, 'q')),
+            '_trans_idx': self.array(data + count * 24, count + 1, 'H'),
+            '_periods': periods,
+            '_tail_start': tail_start,
+            '_tail': tail,
+        })
+
+    def tables(self):
+        zones, links, code_names = {}, {}, {}
+        for index in range(self.zone_count):
+            name_offset, name_length, code_offset, code_length = self.entry(index)[:4]
+            name = self.string(name_offset, name_length)
+            zones[name] = lambda index=index: self.zone(index)
+            code_names[self.string(code_offset, code_length)] = name
+        for index in range(self.link_count):
+            fields = _BINARY_LINK.unpack_from(self.map, self.links_offset + index * _BINARY_LINK.size)
+            name = self.string(*fields[0:2])
+            links[name] = self.string(*fields[4:6])
+            code_names[self.string(*fields[2:4])] = name
+        return zones, links, code_names
+
+_zones, _links, _code_names = _ZoneFile(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), %r)).tables()
+
+timezones = _Registry(_zones, _links)
+"""
+
+def instrument(source, enabled):
+    lines = []
+    for line in source.split('\n'):
+        code = line.lstrip()
+        if not code.startswith('#@stats '):
+            lines.append(line)
+        elif enabled:
+            _, group, key = code.split(' ', 2)
+            lines.append('%s_stats[%r][%s] += 1' % (line[:len(line) - len(code)], group, key))
+    return '\n'.join(lines)
+
+def write_runtime(outf, stats):
+    if stats:
+        outf.write(STATS_FUNCS)
+    for source in (HELPER_FUNCS, LOOKUP_FUNCS, BATCH_FUNCS, REGISTRY_FUNCS):
+        outf.write(instrument(source, stats))
+
+def write_header(outf, what):
+    outf.write('"""\n')
+    outf.write("generated %s\n\n" % (what,))
+    outf.write("Generated from: %s\n" % (GENERATOR_URL,))
+    outf.write(license)
+    outf.write('"""\n\n')
+
+def write_tables(outf, zonesets, linksets, zone_factory):
+    outf.write("\n\n_zones = {\n")
+    for _, z in zonesets.items():
+        outf.write('    ' * 2)
+        outf.write('"%s": %s,\n' % (z.name, zone_factory % (z.code_name,)))
+    outf.write("}")
+    outf.write("\n\n# Links\n_links = {")
+    for _, l in linksets.items():
+        outf.writelines((str(x) for x in l.render(2)))
+    outf.write("\n}")
+    outf.write("\n\n_code_names = {\n")
+    for _, z in zonesets.items():
+        outf.write('    ' * 2)
+        outf.write('"%s": "%s",\n' % (z.code_name, z.name))
+    for _, l in linksets.items():
+        outf.write('    ' * 2)
+        outf.write('"%s": "%s",\n' % (l.code_name, l.name))
+    outf.write("}\n")
+
+    outf.write("\ntimezones = _Registry(_zones, _links)\n")
+
+def write_zonefile(name, rulesets, zonesets, linksets, stats=False):
+    with open("%s.py" % (PKG_NAME,), 'w') as outf:
+        write_header(outf, "%s file" % (PKG_NAME,))
+        outf.write(IMPORTS)
+        write_runtime(outf, stats)
+        outf.write(MODULE_FUNCS)
+
+        outf.write("# Zones sets")
         for _, z in zonesets.items():
             outf.writelines((str(x) for x in z.render()))
-        outf.write("\n# Links")
-        for _, l in linksets.items():
-            outf.writelines((str(x) for x in l.render()))
 
-        outf.write("\n\ntimezones = {\n")
-        for _, z in zonesets.items():
-            outf.write('    ' * 2)
-            outf.write('"%s": %s(),\n' % (z.name, z.code_name))
-        for _, l in linksets.items():
-            outf.write('    ' * 2)
-            outf.write('"%s": %s(),\n' % (l.name, l.code_name))
-        outf.write("}\n")
+        write_tables(outf, zonesets, linksets, '_zone_%s')
+
+def write_package(name, rulesets, zonesets, linksets, stats=False):
+    # One submodule per zone, so that using a zone only loads the code for
+    # that zone
+    path = os.path.join(PKG_NAME, '_zones')
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    with open(os.path.join(path, '__init__.py'), 'w') as outf:
+        outf.write('')
+
+    with open(os.path.join(PKG_NAME, '_runtime.py'), 'w') as outf:
+        write_header(outf, "%s support code" % (PKG_NAME,))
+        outf.write(IMPORTS)
+        write_runtime(outf, stats)
+
+    for _, z in zonesets.items():
+        with open(os.path.join(PKG_NAME, '_zones', '%s.py' % (z.code_name,)), 'w') as outf:
+            outf.write('"""\ngenerated %s zone %s\n"""\n\n' % (PKG_NAME, z.name))
+            outf.write(ZONE_IMPORTS)
+            outf.writelines((str(x) for x in z.render(module=PKG_NAME)))
+            outf.write('\n')
+
+    with open(os.path.join(PKG_NAME, '__init__.py'), 'w') as outf:
+        write_header(outf, "%s package" % (PKG_NAME,))
+        outf.write('from importlib import import_module\n\n')
+        outf.write('from ._runtime import _Registry, RULE_CACHE_SIZE, set_rule_cache_size, '
+                   'PERIOD_CACHE_SIZE, set_period_cache_size, period_cache_info\n')
+        if stats:
+            outf.write('from ._runtime import stats, reset_stats\n')
+        outf.write(MODULE_FUNCS)
+        outf.write(LOADER_FUNCS)
+        write_tables(outf, zonesets, linksets, '_zone_loader("%s")')
+
+def write_binary(name, rulesets, zonesets, linksets, stats=False):
+    data_name = "%s.zdb" % (PKG_NAME,)
+    strings = bytearray()
+    string_refs = {}
+    def string(value):
+        if value not in string_refs:
+            encoded = value.encode('utf-8')
+            string_refs[value] = (len(strings), len(encoded))
+            strings.extend(encoded)
+        return string_refs[value]
+
+    zone_entry, link_entry = struct.Struct(BINARY_ZONE), struct.Struct(BINARY_LINK)
+    period_entry, rule_entry = struct.Struct(BINARY_PERIOD), struct.Struct(BINARY_RULE)
+    zones, links, periods, rules, data = [], [], [], [], bytearray()
+    for _, z in zonesets.items():
+        trans_utc, trans_wall, trans_idx, zone_periods = z.compact()
+        if z.tail is None:
+            # Same as _NO_TAIL in the generated module
+            tail_start, stdoff, tail_name, tail_rules = 1 << 62, 0, (0, 0), ()
+        else:
+            tail_start, stdoff, rule, spans = z.tail
+            tail_name = string(rule)
+            tail_rules = [(year,) + r for year, span_rules in spans
+                          for r in span_rules or [(0, 0, 0, 0, 0, 'w', 0, '')]]
+        offset = len(data)
+        for values, typecode in ((trans_utc, 'q'), (trans_wall[0], 'q'),
+                                 (trans_wall[1], 'q'), (trans_idx, 'H')):
+            a = array(typecode, values)
+            if sys.byteorder == 'big':
+                a.byteswap()
+            data.extend(a.tobytes())
+        data.extend(bytes(-len(data) % 8))
+        zones.append(zone_entry.pack(*(string(z.name) + string(z.code_name)
+                                       + (len(trans_utc), len(zone_periods), len(periods),
+                                          offset, tail_start, stdoff)
+                                       + tail_name + (len(rules), len(tail_rules)))))
+        for off, save, abbr in zone_periods:
+            periods.append(period_entry.pack(off, save, *string(abbr)))
+        for year, month, kind, weekday, day, at, at_type, save, abbr in tail_rules:
+            rules.append(rule_entry.pack(*((year, month, kind, weekday, day,
+                                            BINARY_AT_TYPES.index(at_type), at, save)
+                                           + string(abbr))))
+    for _, l in linksets.items():
+        links.append(link_entry.pack(*(string(l.name) + string(l.code_name) + string(l.target))))
+
+    header = struct.Struct(BINARY_HEADER)
+    periods_offset = header.size + len(zones) * zone_entry.size + len(links) * link_entry.size
+    rules_offset = periods_offset + len(periods) * period_entry.size
+    strings_offset = rules_offset + len(rules) * rule_entry.size
+    data_offset = strings_offset + len(strings)
+    padding = bytes(-data_offset % 8)
+    data_offset += len(padding)
+    with open(data_name, 'wb') as outf:
+        outf.write(header.pack(BINARY_MAGIC, BINARY_VERSION, 0, len(zones), len(links),
+                               periods_offset, rules_offset, strings_offset, data_offset))
+        outf.writelines(zones)
+        outf.writelines(links)
+        outf.writelines(periods)
+        outf.writelines(rules)
+        outf.write(strings)
+        outf.write(padding)
+        outf.write(data)
+
+    with open("%s.py" % (PKG_NAME,), 'w') as outf:
+        write_header(outf, "%s file" % (PKG_NAME,))
+        outf.write(IMPORTS)
+        outf.write(BINARY_IMPORTS)
+        write_runtime(outf, stats)
+        outf.write(MODULE_FUNCS)
+        outf.write(BINARY_FUNCS % (BINARY_MAGIC, BINARY_VERSION, BINARY_HEADER, BINARY_ZONE,
+                                   BINARY_LINK, BINARY_PERIOD, BINARY_RULE, BINARY_AT_TYPES,
+                                   data_name))
@@ -23,6 +23,8 @@ SOFTWARE.
 
 """
 
+from calendar import monthrange
+from datetime import date
 import re
 
 # Sample rule data with header
@@ -41,249 +43,203 @@ import re
 # Rule    US  2007    max -   Mar Sun>=8  2:00    1:00    D
 # Rule    US  2007    max -   Nov Sun>=1  2:00    0   S
 
-# Target code should look something like this (minus comments & whitespace):
-# def __rule_us(dt):
-#     s = 0
-#     l = ''
-# 
-#     # Rule    US  1918    1919    -   Mar lastSun 2:00    1:00    D
-#     if dt.year >= 1918 and dt.year <= 1919 and dt >= __lastSun(dt.year, 3, 2, 0):
-#         s = timedelta(hours=1)
-#         l = 'D'
-# 
-#     # Rule    US  1942    only    -   Feb 9   2:00    1:00    W # War
-#     if dt.year == 1942 and dt >= datetime(dt.year, 2, 9, 2, 0)
-#         s = timedelta(hours=1)
-#         l = 'W'
-# 
-#     # Rule    US  2007    max -   Mar Sun>=8  2:00    1:00    D
-#     if dt.year >= 2007 and dt >= __sunGtEq(dt.year, 3, 8, 2, 0)
-#         s = timedelta(hours=1)
-#         l = 'D'
+# Rule sets are only used at build time: zonecompile resolves zones against
+# them into transition tables, and past the horizon a zone follows the rules
+# span by span, a span being the years over which the same rules apply (2007
+# on in the US rules above).
 
 MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-INDENT = '    '
-
-def name_to_identifier(name):
-    return name.replace('/', '_').replace('-', '_').replace('+', 'plus')
-
-# TODO Clean up to attempt to match PEP8
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
 
 class CompileError(Exception):
     pass
 
-# TODO Get this into some kind of common module - too much code duplication
-class ASO(object):
-    pass
-class RuleSet(ASO):
+def parse_on(on):
+    # Turns an ON field ('5', 'lastSun', 'Sun>=8', 'Sun<=25') into a
+    # (kind, weekday, day) tuple for day_ordinal
+    on = on.strip()
+    try:
+        return ('day', None, int(on))
+    except ValueError:
+        pass
+    try:
+        if on.startswith('last'):
+            kind, wday, day = 'last', on[4:], None
+        elif '>=' in on:
+            wday, day = on.split('>=')
+            kind, day = 'ge', int(day)
+        elif '<=' in on:
+            wday, day = on.split('<=')
+            kind, day = 'le', int(day)
+        else:
+            raise ValueError(on)
+        return (kind, WEEKDAYS.index(wday[:3]), day)
+    except ValueError:
+        raise CompileError("Problem extracting day from %r" % (on,))
+
+def day_ordinal(year, month, on):
+    # Proleptic Gregorian ordinal of the day an ON field lands on; Sun>=N style
+    # rules are allowed to spill over into the next month
+    kind, wday, day = on
+    if kind == 'last':
+        o = date(year, month, monthrange(year, month)[1]).toordinal()
+        return o - ((o + 6) % 7 - wday) % 7
+    o = date(year, month, 1).toordinal() + day - 1
+    if kind == 'ge':
+        return o + (wday - (o + 6) % 7) % 7
+    if kind == 'le':
+        return o - ((o + 6) % 7 - wday) % 7
+    return o
+
+def parse_time(at):
+    # Turns an AT or UNTIL time ('2:00', '1:00u', '2:00:30s', '24:00', '-')
+    # into (seconds, type), type being 'w' (wall), 's' (standard) or 'u' (UTC)
+    at = at.strip()
+    at_type = 'w'
+    if at and at[-1] in 'wsugz':
+        at_type = {'g': 'u', 'z': 'u'}.get(at[-1], at[-1])
+        at = at[:-1]
+    if at in ('', '-'):
+        return 0, at_type
+    neg = at.startswith('-')
+    try:
+        secs = sum(int(p) * m for p, m in zip(at.lstrip('-').split(':'), (3600, 60, 1)))
+    except ValueError:
+        raise CompileError("unable to turn %r to hours:minutes" % (at,))
+    return (-secs if neg else secs), at_type
+
+class RuleSet(object):
     def __init__(self, n):
         self.name = n
-        self.codename = name_to_identifier(n)
-        self.initial_assignments = [Assignment('s', FuncCall('timedelta')), Assignment('l', 'S')]
         self.rule_elements = []
 
-    def render(self, level=0):
-        yield('\n')
-        yield(INDENT * level)
-        yield('def _')
-        yield(self.codename)
-        yield('(dt):')
-        for a in self.initial_assignments:
-            for x in a.render(level + 1):
-                yield(x)
-        for r_ele in self.rule_elements:
-            for x in r_ele.render(level + 1):
-                yield(x)
-        yield('\n')
-        yield(INDENT * (level + 1))
-        yield('return (s, l)')
-
-class RuleElement(ASO):
+    def first_year(self):
+        return max(1, min(r.from_year for r in self.rule_elements))
+
+    def is_open_ended(self):
+        return any(r.to_year is None for r in self.rule_elements)
+
+    def std_letter(self):
+        # Letter in effect before any rule has applied: the one of the
+        # earliest rule that goes back to standard time
+        for r in sorted(self.rule_elements, key=lambda r: r.from_year):
+            if r.save == 0:
+                return r.letter
+        return ''
+
+    def span_starts(self):
+        # The years in which the set of rules that apply changes
+        starts = set(r.from_year for r in self.rule_elements)
+        starts.update(r.to_year + 1 for r in self.rule_elements if r.to_year is not None)
+        return sorted(starts)
+
+    def spans(self, since):
+        # The years from `since` on, split where the rules that apply change,
+        # as (first year, rules) pairs with the rules in calendar order; the
+        # first span starts at `since`
+        return [(start, sorted((r for r in self.rule_elements if r.applies(start)),
+                               key=lambda r: (r.month, r.sort_day())))
+                for start in [since] + [y for y in self.span_starts() if y > since]]
+
+    def last_change(self):
+        # The last year in which the set of rules that apply changes
+        return self.span_starts()[-1]
+
+    def transitions(self, first_year, last_year):
+        # Concrete transitions for the given years, in order, as (local
+        # seconds since the epoch, AT type, save seconds, letter) tuples
+        found = []
+        for year in range(first_year, last_year + 1):
+            found.extend(sorted(r.transition(year) for r in self.rule_elements
+                                if r.applies(year)))
+        return found
+
+class RuleElement(object):
     def __init__(self):
-        self.conditions = []
-        self.assignments = []
-
-    def render(self, level=0):
-        yield('\n')
-        yield(INDENT * level)
-        yield('if ')
-        first=True
-        for c in self.conditions:
-            if not first:
-                yield(' and ')
-            else:
-                first = False
-            for x in c.render(level + 1):
-                yield x
-        if first:
-            yield('True')
-        yield(':')
-        for a in self.assignments:
-            for x in a.render(level + 1):
-                yield x
-
-class Assignment(ASO):
-    def __init__(self, n, v):
-        self.name = n
-        self.value = v
-
-    def render(self, level=0):
-        yield('\n')
-        yield(INDENT * level)
-        yield(self.name)
-        yield(' = ')
-        if isinstance(self.value, ASO):
-            for x in self.value.render(level):
-                yield(x)
-        else:
-            yield(repr(self.value))
-
-class Condition(ASO):
-    def __init__(self, n, o, v):
-        self.name = n
-        self.operator = o
-        self.value = v
-
-    def render(self, level=0):
-        yield('(')
-        yield(self.name)
-        yield(' %s ' % (self.operator,))
-        if isinstance(self.value, ASO):
-            for x in self.value.render(level):
-                yield(x)
-        else:
-            yield(repr(self.value))
-        yield(')')
-
-class FuncCall(ASO):
-    def __init__(self, n, *args, **kwargs):
-        self.name = n
-        self.args = args
-        self.kwargs = kwargs
-
-    def render(self, level=0):
-        yield(self.name)
-        yield('(')
-        first = True
-        for a in self.args:
-            if not first:
-                yield ", "
-            else:
-                first = False
-            if isinstance(a, ASO):
-                for x in a.render(level):
-                    yield(x)
-            else:
-                yield(repr(a))
-
-        for k, v in self.kwargs.items():
-            if not first:
-                yield ", "
-            else:
-                first = False
-            yield(k)
-            yield('=')
-            if isinstance(v, ASO):
-                for x in v.render(level):
-                    yield(x)
-            else:
-                yield(repr(v))
-        yield(')')
-
-class Identifier(ASO):
-    def __init__(self, n):
-        self.name = n
-
-    def render(self, level=0):
-        yield(self.name)
+        self.from_year = None
+        self.to_year = None
+        self.month = None
+        self.on = None
+        self.at = None
+        self.at_type = None
+        self.save = None
+        self.letter = None
+
+    def applies(self, year):
+        return self.from_year <= year and (self.to_year is None or year <= self.to_year)
+
+    def transition(self, year):
+        ordinal = day_ordinal(year, self.month, self.on)
+        return ((ordinal - EPOCH_ORDINAL) * 86400 + self.at, self.at_type,
+                self.save, self.letter)
+
+    def sort_day(self):
+        # Roughly where in the month the rule falls, for ordering
+        kind, _, day = self.on
+        return 31 if kind == 'last' else day
 
 def compile(rules):
     all_rulesets = {}
     for _, rule_list in rules.items():
         for rule in rule_list:
-            # TODO Get logic for all the re.match and ints out of here and
-            #      into parse
+            # The parser only splits the fields; their values are worked
+            # out here
             r_ele = RuleElement()
             try:
                 # Fix for systemV rule entry
-                if rule['from'] == 'min':
+                if rule.from_year == 'min':
                     from_yr = 0
                 else:
-                    from_yr = int(rule['from'])
+                    from_yr = int(rule.from_year)
 
-                if rule['to'] == 'only':
-                    r_ele.conditions.append(Condition('dt.year', '==', from_yr))
-                elif rule['to'] == 'max':
-                    r_ele.conditions.append(Condition('dt.year', '>=', from_yr))
+                if rule.to_year == 'only':
+                    to_yr = from_yr
+                elif rule.to_year == 'max':
+                    to_yr = None
                 else:
-                    r_ele.conditions.append(Condition('dt.year', '>=', from_yr))
-                    r_ele.conditions.append(Condition('dt.year', '<=', int(rule['to'])))
-            except ValueError:
-                raise CompileError("Problem creating condition for 'from %r to %r'"
-                                   % (rule['from'], rule['to']))
-
-            try:
-                in_mo = MONTHS.index(rule['in']) + 1
+                    to_yr = int(rule.to_year)
+                r_ele.from_year = from_yr
+                r_ele.to_year = to_yr
             except ValueError:
-                raise CompileError("Not able to index month %r" % (rule['in'],))
+                raise CompileError("%s: Problem creating condition for 'from %r to %r'"
+                                   % (rule.where, rule.from_year, rule.to_year))
 
             try:
-                on_day = int(rule['on'])
+                in_mo = MONTHS.index(rule.month) + 1
             except ValueError:
-                on_day = None
+                raise CompileError("%s: Not able to index month %r" % (rule.where, rule.month))
 
+            r_ele.month = in_mo
             try:
-                at_h_m = re.match(r'(\d+):?(\d+)?', rule['at']).groups()
-                at_hour = int(at_h_m[0])
-                at_min = int(at_h_m[1]) if at_h_m[1] else 0
-            except AttributeError:
-                raise CompileError("unable to turn %r to hours:minutes" % (rule['at'],))
-
-            # Fix for Jordan Rule:
-            if at_hour >= 24:
-                at_hour = 24 - at_hour
-
-            if on_day:
-                f_call = FuncCall('datetime', Identifier('dt.year'), in_mo, on_day, int(at_hour), int(at_min))
-            else:
-                if any([x in rule['on'] for x in ('=','>','<')]):
-                    try:
-                        f_name, d = re.match(r'( ?[a-zA-Z<>=]+)(\d+)', rule['on']).groups()
-                        d = int(d)
-                        f_name = f_name.strip()
-                    except Exception:
-                        raise CompileError("Problem extracting day from %r" % (rule['on'],))
-                    f_name = f_name.replace('>', 'Gt')
-                    f_name = f_name.replace('<', 'Lt')
-                    f_name = f_name.replace('=', 'Eq')
-                    f_call = FuncCall('__' + f_name, Identifier('dt.year'), in_mo, d, int(at_hour), int(at_min))
-                else:
-                    f_call = FuncCall('__' + rule['on'], Identifier('dt.year'), in_mo, int(at_hour), int(at_min))
-            r_ele.conditions.append(Condition('dt', '>=', Identifier(''.join(f_call.render()))))
+                r_ele.on = parse_on(rule.on)
+                r_ele.at, r_ele.at_type = parse_time(rule.at)
+            except CompileError as e:
+                raise CompileError("%s: %s" % (rule.where, e))
 
-            r_ele.assignments.append(Assignment('l', "%s" % (rule['letter'],)))
+            r_ele.letter = '' if rule.letter == '-' else rule.letter
             try:
-                off_h_m_s = re.match(r'(-)?(\d+):?(\d+)?:?(\d+)?', rule['save']).groups()
+                off_h_m_s = re.match(r'(-)?(\d+):?(\d+)?:?(\d+)?', rule.save).groups()
                 neg = bool(off_h_m_s[0])
                 h = int(off_h_m_s[1])
                 m = int(off_h_m_s[2]) if off_h_m_s[2] else 0
                 s = 0
                 #s = int(off_h_m_s[3]) if off_h_m_s[3] else 0
             except AttributeError:
-                raise CompileError("unable to convert save: %r" % (rule['save'],))
+                raise CompileError("%s: unable to convert save: %r" % (rule.where, rule.save))
             if neg:
                 h = -h
                 m = -m
                 s = -s
-            r_ele.assignments.append(Assignment('s', FuncCall('timedelta', hours=h, minutes=m, seconds=s)))
+            r_ele.save = (h * 60 + m) * 60 + s
 
-            if rule['name'] in all_rulesets:
-                r_set = all_rulesets[rule['name']]
+            if rule.name in all_rulesets:
+                r_set = all_rulesets[rule.name]
             else:
-                r_set = RuleSet(rule['name'])
+                r_set = RuleSet(rule.name)
 
             r_set.rule_elements.append(r_ele)
-            all_rulesets[rule['name']] = r_set
+            all_rulesets[rule.name] = r_set
 
     return all_rulesets
 
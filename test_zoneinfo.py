@@ -5,11 +5,23 @@ Tests the generated zoneinfo module.
 
 """
 
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta, time, timezone
+import os
+import pickle
+import tempfile
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import zoneinfo
 
+import parse
+import rulecompile
+import zonecompile
+
 class TestZoneinfo(unittest.TestCase):
     def test_general_functionality(self):
         """
@@ -23,11 +35,16 @@ class TestZoneinfo(unittest.TestCase):
             now.dst()
             now.strftime("%H:%M:%S %Z")
 
+    def test_registry(self):
+        self.assertTrue('US/Mountain' in zoneinfo.timezones)
+        self.assertFalse('Nowhere/Special' in zoneinfo.timezones)
+        self.assertTrue(zoneinfo.timezones['US/Mountain'] is zoneinfo.timezones['America/Denver'])
+
     def test_mst_mdt(self):
         mst = zoneinfo.timezones['US/Mountain']
         pst = zoneinfo.timezones['US/Pacific']
         dt = datetime(2011, 7, 4, 0, 0, tzinfo=mst)
-        self.assertEqual(dt.utcoffset(), timedelta(hours=-8))
+        self.assertEqual(dt.utcoffset(), timedelta(hours=-6))
         self.assert_("MDT" in dt.strftime("%Y %M %D %h:%m %Z"), "'MDT' not in %r" % (dt.strftime("%Y %M %D %h:%m %Z"),))
 
         dtp = dt.astimezone(pst)
@@ -42,21 +59,208 @@ class TestZoneinfo(unittest.TestCase):
         mst = zoneinfo.timezones['US/Mountain']
         t = time(20, 35, tzinfo=mst)
 
-        self.assert_('-07:00' in t.isoformat() or '-08:00' in t.isoformat())
+        self.assert_('-07:00' in t.isoformat() or '-06:00' in t.isoformat())
+
+    def test_transition_boundaries(self):
+        pst = zoneinfo.timezones['US/Pacific']
+        dt = datetime(2011, 11, 6, 1, 30, tzinfo=pst)
+        self.assertEqual(dt.utcoffset(), timedelta(hours=-7))
+        self.assertEqual(dt.replace(fold=1).utcoffset(), timedelta(hours=-8))
+        self.assertEqual(datetime(2011, 3, 13, 1, 59, tzinfo=pst).tzname(), 'PST')
+        self.assertEqual(datetime(2011, 3, 13, 3, 0, tzinfo=pst).tzname(), 'PDT')
+
+    def test_fromutc(self):
+        pst = zoneinfo.timezones['US/Pacific']
+        first = datetime(2011, 11, 6, 8, 30, tzinfo=timezone.utc).astimezone(pst)
+        second = datetime(2011, 11, 6, 9, 30, tzinfo=timezone.utc).astimezone(pst)
+        self.assertEqual((first.hour, first.fold, first.tzname()), (1, 0, 'PDT'))
+        self.assertEqual((second.hour, second.fold, second.tzname()), (1, 1, 'PST'))
+        spring = datetime(2011, 3, 13, 10, 0, tzinfo=timezone.utc).astimezone(pst)
+        self.assertEqual((spring.hour, spring.tzname()), (3, 'PDT'))
+
+    def test_current_period(self):
+        # Lookups next to the last period found, either side of the fall back
+        pst = zoneinfo.timezones['US/Pacific']
+        self.assertEqual(datetime(2011, 11, 6, 0, 30, tzinfo=pst).tzname(), 'PDT')
+        self.assertEqual(datetime(2011, 11, 6, 1, 30, tzinfo=pst).tzname(), 'PDT')
+        self.assertEqual(datetime(2011, 11, 6, 1, 30, fold=1, tzinfo=pst).tzname(), 'PST')
+        self.assertEqual(datetime(2011, 11, 6, 2, 30, tzinfo=pst).tzname(), 'PST')
+        self.assertEqual(datetime(2011, 11, 6, 1, 30, tzinfo=pst).tzname(), 'PDT')
+        first = datetime(2011, 11, 6, 8, 30, tzinfo=timezone.utc).astimezone(pst)
+        second = datetime(2011, 11, 6, 9, 30, tzinfo=timezone.utc).astimezone(pst)
+        self.assertEqual((first.hour, first.fold), (1, 0))
+        self.assertEqual((second.hour, second.fold), (1, 1))
+        again = datetime(2011, 11, 6, 8, 45, tzinfo=timezone.utc).astimezone(pst)
+        self.assertEqual((again.hour, again.fold, again.tzname()), (1, 0, 'PDT'))
+
+    def test_far_future(self):
+        # Past the precomputed transitions the recurring rules are evaluated
+        syd = zoneinfo.timezones['Australia/Sydney']
+        self.assertEqual(datetime(2050, 1, 4, 12, 0, tzinfo=syd).tzname(), 'AEDT')
+        self.assertEqual(datetime(2050, 7, 4, 12, 0, tzinfo=syd).tzname(), 'AEST')
+        # 2050-04-03 03:00 AEDT falls back to 02:00 AEST, 2050-10-02 02:00 AEST
+        # springs forward to 03:00 AEDT
+        self.assertEqual(datetime(2050, 4, 3, 2, 30, tzinfo=syd).utcoffset(), timedelta(hours=11))
+        self.assertEqual(datetime(2050, 4, 3, 2, 30, fold=1, tzinfo=syd).utcoffset(),
+                         timedelta(hours=10))
+        first = datetime(2050, 4, 2, 15, 30, tzinfo=timezone.utc).astimezone(syd)
+        second = datetime(2050, 4, 2, 16, 30, tzinfo=timezone.utc).astimezone(syd)
+        self.assertEqual((first.hour, first.fold, first.tzname()), (2, 0, 'AEDT'))
+        self.assertEqual((second.hour, second.fold, second.tzname()), (2, 1, 'AEST'))
+        self.assertEqual(datetime(2050, 10, 2, 1, 59, tzinfo=syd).tzname(), 'AEST')
+        self.assertEqual(datetime(2050, 10, 2, 3, 0, tzinfo=syd).tzname(), 'AEDT')
+
+    def test_rule_changes(self):
+        # Each year follows the rules of its own years, whether it falls in
+        # the tables or, with an early --horizon, in the recurring rules
+        la = zoneinfo.timezones['America/Los_Angeles']
+        self.assertEqual(datetime(2006, 3, 20, 12, tzinfo=la).tzname(), 'PST')
+        self.assertEqual(datetime(2007, 3, 20, 12, tzinfo=la).tzname(), 'PDT')
+        self.assertEqual(datetime(2006, 10, 31, 12, tzinfo=la).tzname(), 'PST')
+        self.assertEqual(datetime(2007, 10, 31, 12, tzinfo=la).tzname(), 'PDT')
+        syd = zoneinfo.timezones['Australia/Sydney']
+        self.assertEqual(datetime(2007, 4, 1, 12, tzinfo=syd).tzname(), 'AEST')
+        self.assertEqual(datetime(2008, 4, 1, 12, tzinfo=syd).tzname(), 'AEDT')
+
+    def test_rule_only_zone(self):
+        # EST5EDT follows the US rules for all time, including the years in
+        # which none of them apply
+        est = zoneinfo.timezones['EST5EDT']
+        self.assertEqual(datetime(1917, 7, 1, 12, tzinfo=est).tzname(), 'EST')
+        self.assertEqual(datetime(1919, 7, 1, 12, tzinfo=est).tzname(), 'EDT')
+        self.assertEqual(datetime(1930, 7, 1, 12, tzinfo=est).tzname(), 'EST')
+        self.assertEqual(datetime(1943, 7, 1, 12, tzinfo=est).tzname(), 'EWT')
+        self.assertEqual(datetime(2011, 11, 6, 1, 30, fold=1, tzinfo=est).tzname(), 'EST')
+        self.assertEqual(datetime(2050, 7, 1, 12, tzinfo=est).utcoffset(), timedelta(hours=-4))
+
+    def test_shared_periods(self):
+        # Zones in the same period share its offset, save and abbreviation
+        mst = datetime(2011, 1, 4, 12, 0, tzinfo=zoneinfo.timezones['America/Denver'])
+        phx = datetime(2011, 1, 4, 12, 0, tzinfo=zoneinfo.timezones['America/Phoenix'])
+        self.assertTrue(mst.utcoffset() is phx.utcoffset())
+        self.assertTrue(mst.dst() is phx.dst())
+        self.assertTrue(mst.tzname() is phx.tzname())
+
+    def test_period_cache(self):
+        pst = zoneinfo.timezones['US/Pacific']
+        dt = datetime(2011, 7, 4, 12, 0, 30, tzinfo=pst)
+        dt.utcoffset()
+        before = zoneinfo.period_cache_info()
+        self.assertEqual(dt.strftime('%z %Z'), '-0700 PDT')
+        self.assertEqual(dt.replace(second=59).dst(), timedelta(hours=1))
+        after = zoneinfo.period_cache_info()
+        self.assertEqual(after.misses, before.misses)
+        self.assertTrue(after.hits >= before.hits + 3)
+        zoneinfo.set_period_cache_size(1)
+        try:
+            self.assertTrue(zoneinfo.period_cache_info().currsize <= len(zoneinfo.timezones))
+        finally:
+            zoneinfo.set_period_cache_size(zoneinfo.PERIOD_CACHE_SIZE)
+
+    @unittest.skipUnless(hasattr(zoneinfo, 'stats'), "built without --stats")
+    def test_stats(self):
+        zoneinfo.reset_stats()
+        syd = zoneinfo.timezones['Australia/Sydney']
+        datetime(2050, 1, 4, 12, 0, tzinfo=syd).utcoffset()
+        stats = zoneinfo.stats()
+        self.assertEqual(stats['lookups'], {'Australia/Sydney': 1})
+        self.assertEqual(stats['zones'], {'Australia_Sydney': 1})
+        self.assertEqual(stats['rulesets'], {'AN': 1})
+        zoneinfo.reset_stats()
+        self.assertEqual(zoneinfo.stats()['zones'], {})
+
+    @unittest.skipUnless(hasattr(zoneinfo, 'stats'), "built without --stats")
+    def test_rule_stats(self):
+        # A year no other test looks at is worked out from the rules
+        zoneinfo.reset_stats()
+        syd = zoneinfo.timezones['Australia/Sydney']
+        datetime(2071, 5, 4, 12, 0, tzinfo=syd).utcoffset()
+        stats = zoneinfo.stats()
+        self.assertTrue(stats['rule_years']['AN'] >= 3)
+        self.assertTrue(stats['calls']['_rule_ordinal'] >= 6)
+        self.assertTrue(stats['calls']['_ordinal'] > stats['calls']['_rule_ordinal'])
+        self.assertEqual(stats['rule_cache']['misses'], 1)
+
+    def test_utc_offsets(self):
+        pst = zoneinfo.timezones['US/Pacific']
+        # 2011-11-06 08:30 and 09:30 UTC, either side of the fall back, then 2050-07-01
+        stamps = [1320568200, 1320571800, 2540246400]
+        offsets, dst, abbrs, names = pst.utcoffsets(stamps)
+        self.assertEqual(offsets, [-25200, -28800, -25200])
+        self.assertEqual(dst, [True, False, True])
+        self.assertEqual([names[i] for i in abbrs], ['PDT', 'PST', 'PDT'])
+        if numpy is not None:
+            for values in (numpy.array(stamps, dtype=numpy.int64),
+                           numpy.array(stamps, dtype='datetime64[s]')):
+                offsets, dst, abbrs, names = pst.utcoffsets(values)
+                self.assertEqual(offsets.tolist(), [-25200, -28800, -25200])
+                self.assertEqual(dst.tolist(), [True, False, True])
+                self.assertEqual([names[i] for i in abbrs], ['PDT', 'PST', 'PDT'])
+
+    def test_localize(self):
+        pst = zoneinfo.timezones['US/Pacific']
+        # 2011-11-06 01:30 (repeated), 2011-03-13 02:30 (skipped), 2050-07-01 12:00
+        local = [1320543000, 1299983400, 2540289600]
+        self.assertEqual(pst.localize(local), [1320568200, 1300010400, 2540314800])
+        self.assertEqual(pst.localize(local, ambiguous='later', nonexistent='shift_backward'),
+                         [1320571800, 1300010399, 2540314800])
+        self.assertRaises(ValueError, pst.localize, local[:1], ambiguous='raise')
+        self.assertRaises(ValueError, pst.localize, local[1:], nonexistent='raise')
+        self.assertRaises(ValueError, pst.localize, local, ambiguous='first')
+        if numpy is not None:
+            values = numpy.array(local, dtype='datetime64[s]')
+            self.assertEqual(pst.localize(values).astype(numpy.int64).tolist(),
+                             [1320568200, 1300010400, 2540314800])
+
+    def test_fixed_offset(self):
+        gmt5 = zoneinfo.timezones['Etc/GMT+5']
+        dt = datetime(2011, 7, 4, 12, 0, tzinfo=gmt5)
+        self.assertEqual((dt.utcoffset(), dt.dst(), dt.tzname()), (timedelta(hours=-5), timedelta(0), '-05'))
+        self.assertEqual(datetime(2011, 7, 4, 17, 0, tzinfo=timezone.utc).astimezone(gmt5), dt)
+        self.assertTrue(type(gmt5)() is gmt5)
+        # The shared class is named after its period, whichever zone came first
+        self.assertEqual(type(gmt5).__name__, '_Fixed_minus18000_minus05')
+        self.assertTrue(pickle.loads(pickle.dumps(gmt5)) is gmt5)
+        self.assertEqual(gmt5.utcoffsets([0, 2540246400])[0], [-18000, -18000])
+        self.assertEqual(gmt5.localize([0]), [18000])
 
     def test_historical_sample(self):
         ab = zoneinfo.timezones['Asia/Baku']
         dt = datetime(1991, 8, 30, 12, 0, tzinfo=ab)
-        self.assertEqual(dt.utcoffset(), timedelta(hours=2))
+        self.assertEqual(dt.utcoffset(), timedelta(hours=4))
 
         vi = zoneinfo.timezones['America/Indiana/Vincennes']
         dt = datetime(1955, 6, 1, 12, 0, tzinfo=vi)
-        self.assertEqual(dt.utcoffset(), timedelta(hours=-7))
+        self.assertEqual(dt.utcoffset(), timedelta(hours=-5))
 
         ad = zoneinfo.timezones['Australia/Darwin']
         dt = datetime(1872, 1, 1, 12, 0, tzinfo=ad)
         self.assertEqual(dt.utcoffset(), timedelta(hours=8, minutes=43))
 
+class TestCompileErrors(unittest.TestCase):
+    def compile(self, data):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        zones, rules, _ = parse.parse(path)
+        zonecompile.compile(zones, rulecompile.compile(rules))
+        return path
+
+    def test_rule_position(self):
+        with self.assertRaises(rulecompile.CompileError) as cm:
+            self.compile('Rule\tX\t2000\tmax\t-\tMar\tSun>=\t2:00\t1:00\tD\n')
+        self.assertRegex(str(cm.exception), r'^.+:1: Problem extracting day')
+
+    def test_zone_position(self):
+        with self.assertRaises(zonecompile.CompileError) as cm:
+            self.compile('# header\nZone\tX/Y\t1:00\t-\tLMT\t1900\n'
+                         '\t\t2:00\t-\tXST\t1950 Foo\n\t\t2:00\t-\tXST\n')
+        self.assertRegex(str(cm.exception), r'^.+:3: Error parsing until')
+        with self.assertRaises(zonecompile.CompileError) as cm:
+            self.compile('Zone\tX/Y\t1:00\tNone\tX%sT\n')
+        self.assertRegex(str(cm.exception), r'^.+:1: Zone .X/Y. references unknown rule')
+
 if __name__ == "__main__":
     unittest.main()
 
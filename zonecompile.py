@@ -23,8 +23,11 @@ SOFTWARE.
 
 """
 
+from datetime import date
 import re
 
+import rulecompile
+
 # # Zone  NAME        GMTOFF  RULES   FORMAT  [UNTIL]
 # Zone America/Detroit    -5:32:11 -  LMT 1905
 #             -6:00   -   CST 1915 May 15 2:00
@@ -35,55 +38,45 @@ import re
 #             -5:00   -   EST 1975 Apr 27 2:00
 #             -5:00   US  E%sT
 
-# Target code should look something like this (minus comments and whitespace):
-
-# class America_Detroit(tzinfo):
-#     def __from_rules(self, dt):
-#         offset = None
-#         rule = None
-#         save = None
-#         format = None
-#         letter = None
-#
-#         # Here's the meat and bones of the generated content
-#         if dt.year <= 1905:
-#             offset = timedelta(hours=-5, minutes=-32, seconds=-11)
-#             format = "LMT"
-#             rule = None
-#         elif dt <= datetime(1915, 5, 15, 2, 0):
-#             offset = timedelta(hours=-6)
-#             format = "CST"
-#             rule = None
-#         elif dt.year <= 1946:
-#             offset = timedelta(hours=-5)
-#             format = "E%sT"
-#             rule = __us
-#         else:
-#             offset = timedelta(hours=-5)
-#             format = "E%sT"
-#             rule = __us
-#
-#         # The following is pretty much constant
-#         if rule is not None:
-#             save, letter = rule()
-#         if offset is not None and save is not None:
-#             offset = offset + save
-#         if format is not None and letter is not None:
-#             format = format % letter
-#         return offset, save, format
-# 
-#     def utcoffset(self, dt):
-#         offset, _, _ = self.__from_rules(dt)
-#         return offset.total_seconds // 60
-#     def dst(self, dt):
-#         _, save, _ = self.__from_rules(dt)
-#         return 0 - (save.total_seconds // 60)
-#     def tzname(self, dt):
-#         _, _, format = self.__from_rules(dt)
-#         return format
+# Every offset line and the rules it refers to are resolved at compile time
+# into a sorted table of UTC transitions, each starting a period with a fixed
+# (utc offset, save, abbreviation). The generated class only holds that table;
+# lookups are a binary search. Target code should look something like this:
+
+# def _zone_America_Detroit():
+#     class America_Detroit(_Zone):
+#         _trans_utc = array('q', [-2051202469, -1724083200, ...])
+#         _trans_wall = (array('q', [...]), array('q', [...]))
+#         _trans_idx = array('H', [0, 1, 2, 3, 2, ...])
+#         _periods = (_period(-19920, 0, 'LMT'), _period(-21600, 0, 'CST'), ...)
+#         _tail_start = 2145916800
+#         _tail = _RecurringTail('US', -18000, ((2037, ((3, _GE, 6, 8, 7200, 'w', 3600, 'EDT'),
+#                                                       (11, _GE, 6, 1, 7200, 'w', 0, 'EST'))),))
+#     return America_Detroit
+
+# The tzinfo methods all come from the _Zone base class in the runtime, which
+# looks the periods up in these tables.
+
+# Zones with only one period are rendered as a call to _fixed_zone() instead,
+# which returns a class shared by all zones with that period. Zones made of a
+# single line that follows rules which never end, such as EST5EDT, get empty
+# tables: their one period before the rules start, then the tail.
+# _period() returns pooled (offset, save, abbreviation, offset seconds) tuples,
+# so zones with the same periods share them and their timedelta objects.
+# _trans_wall holds the local view of each transition for fold=0 and fold=1,
+# _trans_idx the period in effect before the first transition and after each
+# one. fromutc() searches _trans_utc directly. The tables run to the end of
+# the horizon year (HORIZON_YEAR, or later if the zone's current line starts
+# after it); past that, zones whose rules never end follow them year by year,
+# each year taking the rules of its span of years, kept in _tail. The class is
+# only created, by the timezones registry, the first time the zone is looked
+# up.
 
 MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 INDENT = '    '
+HORIZON_YEAR = 2037
+NO_TAIL = '_NO_TAIL'
+RULE_KINDS = ['day', 'last', 'ge', 'le']
 
 def name_to_identifier(name):
     return name.replace('/', '_').replace('-', '_').replace('+', 'plus')
@@ -91,6 +84,53 @@ def name_to_identifier(name):
 class CompileError(Exception):
     pass
 
+def parse_gmtoff(gmtoff):
+    try:
+        secs = rulecompile.parse_time(gmtoff)[0]
+    except rulecompile.CompileError:
+        raise CompileError("Error parsing gmtoff: %r" % (gmtoff,))
+    # Sub-minute offsets (mostly LMT) are truncated to whole minutes
+    return -(-secs // 60 * 60) if secs < 0 else secs // 60 * 60
+
+def parse_until(until):
+    # Returns the local time of an UNTIL field as (seconds since the epoch,
+    # type), with the type as for rulecompile.parse_time
+    parts = until.split()
+    try:
+        year = int(parts[0])
+        month = MONTHS.index(parts[1][:3]) + 1 if len(parts) > 1 else 1
+        on = rulecompile.parse_on(parts[2]) if len(parts) > 2 else ('day', None, 1)
+        at, at_type = rulecompile.parse_time(parts[3]) if len(parts) > 3 else (0, 'w')
+    except (ValueError, rulecompile.CompileError):
+        raise CompileError("Error parsing until: %r" % (until,))
+    ordinal = rulecompile.day_ordinal(year, month, on)
+    return ((ordinal - rulecompile.EPOCH_ORDINAL) * 86400 + at, at_type)
+
+def year_start(year):
+    # Seconds since the epoch at the start of the year
+    return (date(year, 1, 1).toordinal() - rulecompile.EPOCH_ORDINAL) * 86400
+
+def to_utc(local, at_type, stdoff, save):
+    if at_type == 'u':
+        return local
+    if at_type == 's':
+        return local - stdoff
+    return local - stdoff - save
+
+def numeric_abbreviation(utcoff):
+    sign = '-' if utcoff < 0 else '+'
+    h, m = divmod(abs(utcoff) // 60, 60)
+    return '%s%02d%02d' % (sign, h, m) if m else '%s%02d' % (sign, h)
+
+def abbreviation(fmt, letter, save, utcoff):
+    if '/' in fmt:
+        fmt = fmt.split('/')[1 if save else 0]
+    if '%s' in fmt:
+        fmt = fmt.replace('%s', letter)
+    if '%z' in fmt:
+        fmt = fmt.replace('%z', numeric_abbreviation(utcoff))
+    return fmt
+
 class ASO(object):
     pass
 
@@ -99,248 +139,256 @@ class Zone(ASO):
         self.name = n
         self.code_name = name_to_identifier(n)
         self.offsets = []
-
-    def render(self, level=0):
+        self.periods = []
+        self.horizon = HORIZON_YEAR
+        self.tail = None
+
+    def resolve(self, rulesets, last_year=HORIZON_YEAR):
+        # Walks the offset lines in order, applying each one's rules, and
+        # returns the (utc start, utc offset, save, abbreviation) periods they
+        # produce. The first period has no start.
+        periods = []
+        start = None
+        prev_stdoff = prev_save = 0
+        for o in self.offsets:
+            save = o.rule if isinstance(o.rule, int) else 0
+            letter = ''
+            trans = []
+            if isinstance(o.rule, str):
+                try:
+                    ruleset = rulesets[o.rule]
+                except KeyError:
+                    raise CompileError("%s: Zone %r references unknown rule %r"
+                                       % (o.where, self.name, o.rule))
+                letter = ruleset.std_letter()
+                until_year = last_year
+                if o.until is not None:
+                    until_year = min(last_year, date.fromordinal(
+                        o.until[0] // 86400 + rulecompile.EPOCH_ORDINAL).year)
+                trans = ruleset.transitions(ruleset.first_year(), until_year)
+
+            # Rules which took effect before this line started set its
+            # initial save and letter. As in zic, this is judged by the clock
+            # of the previous line, so a rule and an UNTIL written for the same
+            # wall time coincide.
+            i = 0
+            while start is not None and i < len(trans):
+                t_local, t_type, t_save, t_letter = trans[i]
+                if to_utc(t_local, t_type, prev_stdoff, prev_save) > start:
+                    break
+                save, letter = t_save, t_letter
+                i += 1
+            periods.append((start, o.stdoff + save, save,
+                            abbreviation(o.format, letter, save, o.stdoff + save)))
+
+            for t_local, t_type, t_save, t_letter in trans[i:]:
+                at = to_utc(t_local, t_type, o.stdoff, save)
+                if o.until is not None and at >= to_utc(o.until[0], o.until[1], o.stdoff, save):
+                    break
+                save, letter = t_save, t_letter
+                periods.append((at, o.stdoff + save, save,
+                                abbreviation(o.format, letter, save, o.stdoff + save)))
+
+            if o.until is None:
+                break
+            start = to_utc(o.until[0], o.until[1], o.stdoff, save)
+            prev_stdoff, prev_save = o.stdoff, save
+
+        # Drop periods which never take effect, or which don't change anything
+        merged = []
+        for p in periods:
+            while merged and merged[-1][0] is not None and p[0] <= merged[-1][0]:
+                merged.pop()
+            if merged and merged[-1][1:] == p[1:]:
+                continue
+            merged.append(p)
+        return merged
+
+    def prune(self, since=None, until=None):
+        # Collapses the history before the start of `since` into the period in
+        # effect then, and that after the end of `until` into the one in effect
+        # at the end; lookups in between are unchanged. The tables have to run
+        # to the end of `since` and `until`, see compile().
+        periods = self.periods
+        if since is not None:
+            cutoff = year_start(since)
+            first = 0
+            while first + 1 < len(periods) and periods[first + 1][0] <= cutoff:
+                first += 1
+            periods = [(None,) + tuple(periods[first][1:])] + periods[first + 1:]
+        if until is not None:
+            cutoff = year_start(until + 1)
+            periods = [p for p in periods if p[0] is None or p[0] < cutoff]
+            self.tail = None
+        self.periods = periods
+
+    def compact(self):
+        # Splits the periods into the arrays used by the generated class
+        periods = []
+        trans_utc, trans_wall, trans_idx = [], ([], []), []
+        prev = None
+        for start, off, save, abbr in self.periods:
+            if (off, save, abbr) not in periods:
+                periods.append((off, save, abbr))
+            trans_idx.append(periods.index((off, save, abbr)))
+            if start is not None:
+                trans_utc.append(start)
+                trans_wall[0].append(start + max(prev, off))
+                trans_wall[1].append(start + min(prev, off))
+            prev = off
+        return trans_utc, trans_wall, trans_idx, periods
+
+    def signature(self):
+        # Everything the generated code depends on but the names, so zones
+        # with the same signature behave the same
+        tail = self.tail and (self.tail[0], self.tail[1], self.tail[3])
+        return (tuple(self.periods), tail)
+
+    def is_fixed(self):
+        return len(self.periods) == 1 and self.tail is None
+
+    def render(self, level=0, module=None):
+        trans_utc, trans_wall, trans_idx, periods = self.compact()
         yield('\n')
         yield(INDENT * level)
-        yield('class ')
+        yield('def _zone_')
         yield(self.code_name)
-        yield('(tzinfo):')
+        yield('():')
         level += 1
-        yield('\n')
-        yield(INDENT * level)
-        yield('def __from_rules(self, dt):')
-        level += 1
-        for x in ('rule','format','letter'):
+        if self.is_fixed():
+            # One period for all time: a shared fixed offset class will do
             yield('\n')
             yield(INDENT * level)
-            yield(x)
-            yield(' = None')
-        for x in ('offset', 'save'):
-            yield('\n')
-            yield(INDENT * level)
-            yield(x)
-            yield(' = timedelta()')
+            yield('return _fixed_zone(%d, %d, %r)' % periods[0])
+            return
         yield('\n')
         yield(INDENT * level)
-        yield('if dt:')
-        level += 1
-        yield('\n')
-        yield(INDENT * level)
-        yield('dt = datetime(dt.year, dt.month, dt.day, dt.hour, dt.minute)')
-        level -= 1
-        yield('\n')
-        yield(INDENT * level)
-        yield('else:')
+        yield('class ')
+        yield(self.code_name)
+        yield('(_Zone):')
         level += 1
+        # Named as if defined at the top level module, which its __getattr__
+        # makes true, so instances still pickle
         yield('\n')
         yield(INDENT * level)
-        yield('dt = datetime.now()')
-        level -= 1
-        first = True
-        for o in self.offsets:
-            for x in o.render(level, first):
-                yield(x)
-            first = False
-        for line in ["if rule is not None:",
-                     "    save, letter = rule(dt)",
-                     "if offset is not None and save is not None:",
-                     "    offset = offset - save",
-                     "if format is not None and letter is not None and '%' in format:",
-                     "    format = format % letter",
-                     "return offset, save, format"]:
+        yield('__qualname__ = %r' % (self.code_name,))
+        if module is not None:
             yield('\n')
             yield(INDENT * level)
-            yield(line)
-        level -= 1
-        for line in ["def utcoffset(self, dt):",
-                     "    offset, _, _ = self.__from_rules(dt)",
-                     "    return offset",
-                     "def dst(self, dt):",
-                     "    _, save, _ = self.__from_rules(dt)",
-                     "    return save",
-                     "def tzname(self, dt):",
-                     "    _, _, format = self.__from_rules(dt)",
-                     "    return format"]:
+            yield('__module__ = %r' % (module,))
+        attributes = [
+            ('_trans_utc', "array('q', %r)" % (trans_utc,)),
+            ('_trans_wall', "(array('q', %r), array('q', %r))" % trans_wall),
+            ('_trans_idx', "array('H', %r)" % (trans_idx,)),
+            ('_periods', '(%s,)' % (', '.join('_period(%d, %d, %r)' % period
+                                              for period in periods),)),
+        ]
+        if self.tail is None:
+            attributes.append(('_tail_start', NO_TAIL))
+            attributes.append(('_tail', 'None'))
+        else:
+            tail_start, stdoff, rule, spans = self.tail
+            attributes.append(('_tail_start', repr(tail_start)))
+            attributes.append(('_tail', '_RecurringTail(%r, %d, (%s,))' % (
+                rule, stdoff, ', '.join('(%d, (%s))' % (year, ' '.join(
+                    '(%d, _%s, %d, %d, %d, %r, %d, %r),' % ((r[0], RULE_KINDS[r[1]].upper()) + r[2:])
+                    for r in rules))
+                    for year, rules in spans))))
+        for name, value in attributes:
             yield('\n')
             yield(INDENT * level)
-            yield(line)
+            yield(name)
+            yield(' = ')
+            yield(value)
+        yield('\n')
+        yield(INDENT * (level - 1))
+        yield('return ')
+        yield(self.code_name)
 
 class Offset(ASO):
     def __init__(self):
-        self.condition = None
-        self.assignments = []
-
-    def render(self, level=0, first=False):
-        if self.condition:
-            yield('\n')
-            yield(INDENT * level)
-            if first:
-                yield('if ')
-            else:
-                yield('elif')
-            for x in self.condition.render(level):
-                yield(x)
-            yield(':')
-            level += 1
-        else:
-            if not first:
-                yield('\n')
-                yield(INDENT * level)
-                yield('else:')
-                level += 1
-        for a in self.assignments:
-            for x in a.render(level):
-                yield(x)
-
-class Assignment(ASO):
-    def __init__(self, n, v):
-        self.name = n
-        self.value = v
-
-    def render(self, level=0):
-        yield('\n')
-        yield(INDENT * level)
-        yield(self.name)
-        yield(' = ')
-        if isinstance(self.value, ASO):
-            for x in self.value.render(level):
-                yield(x)
-        else:
-            yield(repr(self.value))
-
-class Condition(ASO):
-    def __init__(self, n, o, v):
-        self.name = n
-        self.operator = o
-        self.value = v
-
-    def render(self, level=0):
-        yield('(')
-        yield(self.name)
-        yield(' %s ' % (self.operator,))
-        if isinstance(self.value, ASO):
-            for x in self.value.render(level):
-                yield(x)
-        else:
-            yield(repr(self.value))
-        yield(')')
+        self.stdoff = 0
+        self.rule = None
+        self.format = None
+        self.until = None
+        self.where = None
 
-class FuncCall(ASO):
-    def __init__(self, n, *args, **kwargs):
-        self.name = n
-        self.args = args
-        self.kwargs = kwargs
-
-    def render(self, level=0):
-        yield(self.name)
-        yield('(')
-        first = True
-        for a in self.args:
-            if not first:
-                yield ", "
-            else:
-                first = False
-            if isinstance(a, ASO):
-                for x in a.render(level):
-                    yield(x)
-            else:
-                yield(repr(a))
-
-        for k, v in self.kwargs.items():
-            if not first:
-                yield ", "
-            else:
-                first = False
-            yield(k)
-            yield('=')
-            if isinstance(v, ASO):
-                for x in v.render(level):
-                    yield(x)
-            else:
-                yield(repr(v))
-        yield(')')
-
-class Identifier(ASO):
-    def __init__(self, n):
-        self.name = n
-
-    def render(self, level=0):
-        yield(self.name)
-
-def compile(zones):
+def compile(zones, rulesets, horizon=HORIZON_YEAR, until=None, since=None):
     all_zones = {}
     for name, zone in zones.items():
-        offsets = zone['offsets']
+        offsets = zone.lines
 
         z_obj = Zone(name)
 
         for offset in offsets:
-
-            # Get and set up gmt offset
             o_obj = Offset()
-
+            o_obj.where = offset.where
             try:
-                gmt_off = re.match(r'( ?-?)?(\d+):?(\d+)?:?(\d+)?', offset['gmtoff']).groups()
-            except AttributeError:
-                raise CompileError("Error parsing gmtoff: %r" % (offset['gmtoff'],))
-
-            neg = gmt_off[0] == '-'
-            hours = int(gmt_off[1])
-            mins = int(gmt_off[2]) if gmt_off[2] else 0
-            secs = 0
-            #secs = int(gmt_off[3]) if gmt_off[3] else 0
-
-            if neg:
-                hours = -hours
-                mins = -mins
-                secs = -secs
-
-            o_obj.assignments.append(Assignment('offset', FuncCall('timedelta',
-                                     hours=hours, minutes=mins, seconds=secs)))
-
-            # Get and set up rule assignment
-            rule = offset['rules']
-            if not rule or rule.strip() == '-':
-                rule_name = None
-            elif re.match(r'\d{1,2}:?\d{0,2}:?\d{0,2}', rule):
-                rule_name = {'1:00': '_rule_constant_1hour',
-                             '0:30': '_rule_constant_30min',
-                             '0:20': '_rule_constant_20min'}[rule.strip()]
-            else:
-                rule_name = '_' + name_to_identifier(rule)
-
-            o_obj.assignments.append(Assignment('rule', Identifier(rule_name)))
-
-            # Get and set up format
-            fmt = offset['format']
-
-            o_obj.assignments.append(Assignment('format', fmt))
-
-            # Get and set up the condition
-            if offset['until']:
-                # TODO These times appear to be local in the file, which could
-                #      wreak all sorts of havok with conversions. Fix this!
-                try:
-                    u_parts = re.match(r'(\d{4}) ?(\w{3})? ?(\d+)? ?(\d+)?:?(\d+)?',
-                                       offset['until']).groups()
-                except AttributeError:
-                    raise CompileError("Error parsing until: %r" % (offset['until'],))
-
-                u_year = int(u_parts[0])
-                u_mon = u_parts[1]
-                u_day = int(u_parts[2]) if u_parts[2] else 1
-                u_hour = int(u_parts[3]) if u_parts[3] else 0
-                u_mins = int(u_parts[4]) if u_parts[4] else 0
+                o_obj.stdoff = parse_gmtoff(offset.gmtoff)
+
+                # The rule is either absent, a fixed amount of saved time or
+                # the name of a ruleset
+                rule = offset.rules
+                if not rule or rule.strip() == '-':
+                    o_obj.rule = None
+                elif re.match(r'-?\d{1,2}:?\d{0,2}:?\d{0,2}', rule):
+                    try:
+                        o_obj.rule = rulecompile.parse_time(rule)[0]
+                    except rulecompile.CompileError:
+                        raise CompileError("Error parsing rule: %r" % (rule,))
+                else:
+                    o_obj.rule = rule.strip()
+
+                o_obj.format = offset.format
+
+                if offset.until:
+                    o_obj.until = parse_until(offset.until)
+            except CompileError as e:
+                raise CompileError("%s: %s" % (offset.where, e))
 
-                try:
-                    u_mon_i = MONTHS.index(u_mon) + 1 if u_mon else 1
-                except ValueError:
-                    raise CompileError("Not able to index month %r" % (rule['in'],))
+            z_obj.offsets.append(o_obj)
 
-                comp = Condition('dt', '<', Identifier('datetime(%s,%s,%s,%s,%s)' % (u_year, u_mon_i, u_day, u_hour, u_mins)))
+        # The tables run at least to the horizon, and on to the last year the
+        # zone's current line starts in. They also have to cover `since` and
+        # `until` for Zone.prune(). Past them the tail takes the rules span by span, so it
+        # only needs rules in the horizon year and in the span that never
+        # ends; otherwise the tables run on to the last year the rules change.
+        last = z_obj.offsets[-1]
+        ruleset = rulesets.get(last.rule) if isinstance(last.rule, str) else None
+        z_obj.horizon = max(horizon, since or 0, until or 0)
+        if len(z_obj.offsets) > 1:
+            z_obj.horizon = max(z_obj.horizon, date.fromordinal(
+                z_obj.offsets[-2].until[0] // 86400 + rulecompile.EPOCH_ORDINAL).year)
+        if ruleset is not None:
+            spans = ruleset.spans(z_obj.horizon)
+            if not spans[0][1] or not spans[-1][1]:
+                z_obj.horizon = max(z_obj.horizon, ruleset.last_change())
+                spans = ruleset.spans(z_obj.horizon)
+        if len(z_obj.offsets) == 1 and since is None and until is None and \
+                ruleset is not None and ruleset.is_open_ended():
+            # With no history beyond its rules the zone needs no table: the
+            # tail covers every year from the first the rules apply in, so
+            # the horizon plays no part. With --since or --until it does, as
+            # prune() can only clamp the tables. The tail starts each year from the
+            # period the last rule of the year before leaves, which has to be
+            # the one in effect before the rules.
+            first = ruleset.first_year()
+            first_spans = ruleset.spans(first)
+            after = max(first_spans[0][1], key=lambda r: r.transition(first))
+            if after.save == 0 and abbreviation(last.format, after.letter, 0, last.stdoff) == \
+                    abbreviation(last.format, ruleset.std_letter(), 0, last.stdoff):
+                z_obj.horizon = first - 1
+                spans = first_spans
+        z_obj.periods = z_obj.resolve(rulesets, z_obj.horizon)
+
+        if ruleset is not None and ruleset.is_open_ended():
+            spans = tuple((year, tuple((r.month, RULE_KINDS.index(r.on[0]), r.on[1] or 0,
+                                        r.on[2] or 0, r.at, r.at_type, r.save,
+                                        abbreviation(last.format, r.letter, r.save,
+                                                     last.stdoff + r.save))
+                                       for r in rules))
+                          for year, rules in spans)
+            z_obj.tail = (year_start(z_obj.horizon + 1), last.stdoff, last.rule, spans)
 
-                o_obj.condition = comp
-            z_obj.offsets.append(o_obj)
         all_zones[name] = z_obj
     return all_zones